@@ -1,30 +1,32 @@
 import streamlit as st
-import tarfile
-from pathlib import Path
-import re
-import yaml
-import pandas as pd
 
 # Custom imports
 from multipage import MultiPage
-from options import EDA, DiffAb, Summary, Pathway, Assembly, Expression, Home
+import bundle
+import profiling
 st.set_page_config(page_title="NCCR Microbiomes ETHZ", layout='wide')
 
 #DATADIR = Path('/Users/ansintsova/git_repos/tnseq_app/data/ath_rnaseq')
 #DATADIR = Path('/Users/ansintsova/git_repos/tnseq_app/data/results_for_app')
 
 st.title(":microscope: Welcome to MiBio App :microscope:")
-fname = st.sidebar.file_uploader('Project Results', accept_multiple_files=False)
+fnames = st.sidebar.file_uploader('Project Results', accept_multiple_files=True,
+                                  help='Upload several projects to compare them')
 
-if not fname:
+if not fnames:
     st.stop()
-tar = tarfile.open(fileobj=fname, mode="r:gz")
-tar.extractall()
-DATADIR = Path(tar.getnames()[0])
-config_file = DATADIR/'pages.yaml'
-
-with open(config_file) as fh:
-    config = yaml.safe_load(fh)
+profiling.begin()
+# Hash each upload only once per session, the extracted tree is shared between sessions
+upload_keys = [(getattr(fname, 'id', None), fname.name, fname.size) for fname in fnames]
+digests = st.session_state.get('upload_digests', {})
+digests = {key: digests.get(key) or bundle.hash_upload(fname) for key, fname in zip(upload_keys, fnames)}
+st.session_state['upload_digests'] = digests
+# Compared projects need their results whatever pages they enable
+page_inputs = bundle.comparison_inputs() if len(fnames) > 1 else None
+with profiling.stage('open_bundle', 'load'):
+    projects = [bundle.open_bundle(fname, digests[key], page_inputs) for key, fname in zip(upload_keys, fnames)]
+# Pages of a single project are shown for the first upload
+DATADIR, config, digest = projects[0]
 
 
 
@@ -34,19 +36,23 @@ project_sites = config['pages']
 
 # # results = {
 # #            'Summary': ('Summary', Summary.app, DATADIR),
-# #            'Path': ('Pathway Analysis',  Pathway.app, DATADIR),
-# #            'Assembly': ('Assembly', Assembly.app, DATADIR)}
+# #            'Path': ('Pathway Analysis',  Pathway.app, DATADIR)}
 #
 
-available_pages = {'Home': ('Home', Home.app, DATADIR),
-           'EDA': ('Exploratory Data Analysis', EDA.app, DATADIR),
-           'DiffAb': ('Differential Expression/Abundance', DiffAb.app, DATADIR),
-           'Expression': ('Gene Expression', Expression.app, DATADIR)}
+# Pages are given by module path and only imported once selected
+available_pages = {'Home': ('Home', 'options.Home', DATADIR),
+           'EDA': ('Exploratory Data Analysis', 'options.EDA', DATADIR),
+           'DiffAb': ('Differential Expression/Abundance', 'options.DiffAb', DATADIR),
+           'Expression': ('Gene Expression', 'options.Expression', DATADIR),
+           'Pathway': ('Pathway Analysis', 'options.Pathway', DATADIR),
+           'Assembly': ('Assembly', 'options.Assembly', DATADIR)}
 
 for page_name, page in available_pages.items():
     if page_name not in project_sites:
         continue
     app.add_page(page[0], page[1], page[2])
+if len(projects) > 1:
+    app.add_page('Compare Projects', 'options.Comparison', [datadir for datadir, _, _ in projects])
 
 # The main app
 app.run()
\ No newline at end of file
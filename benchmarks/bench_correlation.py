@@ -0,0 +1,93 @@
+"""
+Benchmark visualize.calculate_correlation against the groupby().corr() implementation it replaced.
+
+usage: python benchmarks/bench_correlation.py [--samples 2000] [--controls 20] [--repeat 3]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from options import visualize
+
+
+def reference_correlation(exp_df, control_file, for_each='sampleID', how='log', cutoff=0.9):
+    """The previous implementation, kept here as the baseline."""
+    controls = pd.read_table(control_file, names=['barcode', 'phenotype', 'conc'])
+    control_cnts = exp_df[exp_df.barcode.isin(controls.barcode)].copy()
+    if how == 'raw':
+        col1 = 'conc'
+        col2 = 'cnt'
+    else:
+        control_cnts['logConc'] = np.log10(control_cnts['conc'])
+        col1 = 'logConc'
+        if how == 'log':
+            control_cnts['logCnts'] = np.log10(control_cnts['cnt'])
+        elif how == 'log_w_0':
+            control_cnts['logCnts'] = np.log10(control_cnts['cnt'].replace({0: 1}))
+        col2 = 'logCnts'
+    corr_df = control_cnts.groupby(['phenotype', for_each])[[col1, col2]].corr()
+    corr_df = corr_df.reset_index()
+    corr_df = corr_df[corr_df['level_2'] == col1].drop(['level_2', col1], axis=1)
+    corr_df.columns = ['phenotype', 'sampleID', 'R']
+
+    good_samples = corr_df[(corr_df.R > cutoff) & (corr_df.phenotype == 'wt')].sampleID.values
+    return corr_df, good_samples
+
+
+def make_data(n_samples, n_controls, n_barcodes=500, seed=0):
+    """Counts for n_samples samples with n_controls spiked-in control barcodes of two phenotypes."""
+    rng = np.random.default_rng(seed)
+    controls = pd.DataFrame({'barcode': [f'ctrl{i}' for i in range(n_controls)],
+                             'phenotype': np.where(np.arange(n_controls) % 2 == 0, 'wt', 'mut'),
+                             'conc': 10.0 ** rng.uniform(-5, -1, n_controls)})
+    barcodes = np.concatenate([controls.barcode.to_numpy(), [f'bc{i}' for i in range(n_barcodes)]])
+    conc = np.concatenate([controls.conc.to_numpy(), np.full(n_barcodes, 1e-4)])
+    samples = np.repeat([f'sample{i}' for i in range(n_samples)], len(barcodes))
+    cnt = rng.poisson(np.tile(conc, n_samples) * 1e6 * rng.uniform(0.5, 2, len(samples)))
+    exp_df = pd.DataFrame({'barcode': np.tile(barcodes, n_samples), 'sampleID': samples, 'cnt': cnt})
+    # The reference implementation expects the control annotation on the counts already
+    exp_df = exp_df.merge(controls, on='barcode', how='left')
+    return exp_df, controls
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(n_samples, n_controls, repeat):
+    exp_df, controls = make_data(n_samples, n_controls)
+    with tempfile.TemporaryDirectory() as tmp:
+        control_file = Path(tmp) / 'controls.tsv'
+        controls.to_csv(control_file, sep='\t', header=False, index=False)
+        print(f'{len(exp_df)} count rows, {n_samples} samples, {n_controls} controls')
+        for how in visualize.CORRELATION_MODES:
+            ref_time, (ref, _) = best_of(lambda: reference_correlation(exp_df, control_file, how=how), repeat)
+            new_time, (new, _) = best_of(lambda: visualize.calculate_correlation(exp_df, control_file, how=how), repeat)
+            merged = ref.merge(new, on=['phenotype', 'sampleID'], suffixes=('_ref', '_new'))
+            diff = (merged.R_ref - merged.R_new).abs().max()
+            print(f'{how:8s} reference {ref_time:8.3f}s  engine {new_time:8.3f}s  '
+                  f'speedup {ref_time / new_time:6.1f}x  max |dR| {diff:.2e}')
+        all_time, _ = best_of(lambda: visualize.control_correlations(exp_df, visualize.load_controls(control_file)),
+                              repeat)
+        print(f'all modes in one pass {all_time:8.3f}s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--controls', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.samples, args.controls, args.repeat)
@@ -0,0 +1,312 @@
+"""
+Time the analysis hot paths on a synthetic project and compare them to a stored baseline.
+
+usage: python benchmarks/run_benchmarks.py [--genes 20000] [--samples 48] [--contrasts 6] [--pathways 300]
+                                           [--repeat 3] [--only find_PCs ...] [--save-baseline] [--baseline FILE]
+
+Runs without a Streamlit server. Every case returns a small summary of its result
+(counts, rounded sums) that is compared to the baseline along with its run time, so a
+change that makes a path faster but different is reported too. The exit status is 1 when
+a summary differs, a case is slower than --tolerance times its baseline or there is no
+baseline. benchmarks/baseline.json was recorded with the default parameters; timings depend
+on the machine, so record a local baseline with --save-baseline --baseline FILE before comparing
+changes elsewhere.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import datasets
+from benchmarks.bench_correlation import best_of
+from benchmarks import synthetic
+from options import DiffAb, EDA, Expression, concordance, enrichment, genesearch, visualize
+from options import contrasts as contrasts_engine
+from scripts import process_gmt
+
+BASELINE = Path(__file__).with_name('baseline.json')
+CASES = {}
+
+
+def case(name):
+    """Register a benchmark. The decorated function sets up and returns (run, summarize)."""
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+
+def _round(x, digits=6):
+    return float(np.round(float(x), digits))
+
+
+class Project:
+    """A generated project, with its tables loaded once for the cases that do not time loading."""
+
+    def __init__(self, datadir, barcode_genes) -> None:
+        self.datadir = Path(datadir)
+        self.data = datasets.DatasetRegistry(self.datadir)
+        self.config = self.data.config
+        self.results = self.data.get('results')
+        self.vsd = self.data.get('vsd')
+        self.tpms = self.data.get('tpms')
+        self.sample_data = self.data.get('sample_data')
+        self.barcode_genes = barcode_genes
+        self._counts = None
+
+    @property
+    def counts(self):
+        if self._counts is None:
+            self._counts = synthetic.make_barcode_counts(genes=self.barcode_genes)
+        return self._counts
+
+
+@case('load_tables')
+def load_tables(p):
+    def run():
+        data = datasets.DatasetRegistry(p.datadir)
+        return [data.get(name) for name in ('sample_data', 'results', 'vsd', 'tpms')]
+    return run, lambda frames: {'rows': [len(f) for f in frames],
+                                'results_mb': _round(datasets.frame_nbytes(frames[1]) / 1e6, 1)}
+
+
+def _pca_summary(out):
+    pDf, pc_var = out
+    return {'pc_var': pc_var, 'abs_pc1': _round(pDf['PC1'].abs().sum(), 3)}
+
+
+@case('find_PCs_variance')
+def find_pcs_variance(p):
+    return (lambda: EDA.find_PCs(p.vsd, p.sample_data, 2, 500)), _pca_summary
+
+
+@case('find_PCs_all_genes')
+def find_pcs_all(p):
+    return (lambda: EDA.find_PCs(p.vsd, p.sample_data, 2)), _pca_summary
+
+
+@case('find_PCs_lfc')
+def find_pcs_lfc(p):
+    lfc = p.config['lfc_col'][0]
+
+    def run():
+        orders = EDA.lfc_order(p.results, p.vsd, 'Name', lfc)
+        return EDA.find_PCs(p.vsd, p.sample_data, 2, 500, 'log2FoldChange', lfc_orders=orders)
+    return run, _pca_summary
+
+
+@case('sample_clustering')
+def sample_clustering(p):
+    def run():
+        return EDA.cluster_samples(p.vsd, 500, 'pearson')
+    return run, lambda out: {'mean_distance': _round(out[0].mean(), 4), 'height': _round(out[1][-1, 2], 4)}
+
+
+@case('diffab_filter')
+def diffab_filter(p):
+    lfc, pval = p.config['lfc_col'][0], p.config['pval_col'][0]
+
+    def run():
+        # The volcano plot path of DiffAb.app for every contrast
+        hits = {}
+        for con in p.results['contrast'].unique():
+            df = DiffAb.plot_table(p.data.contrast_rows(con), lfc, pval, 'Name', 1, 0.05)
+            hits[str(con)] = int(df['hit'].sum())
+        return hits
+    return run, lambda hits: {'hits': hits}
+
+
+@case('diffab_intersection')
+def diffab_intersection(p):
+    lfc, pval = p.config['lfc_col'][0], p.config['pval_col'][0]
+
+    def run():
+        matrix = contrasts_engine.pivot_results(p.results, 'Name', lfc, pval)
+        filters = {c: (1.0, 0.05) for c in matrix.contrasts}
+        return [contrasts_engine.select_genes(matrix, filters, how, 2) for how in ('all', 'any', 'at_least')]
+    return run, lambda out: {'selected': [len(genes) for genes, _ in out], 'regions': len(out[1][1])}
+
+
+@case('pathway_enrichment')
+def pathway_enrichment(p):
+    lfc, pval = p.config['lfc_col'][0], p.config['pval_col'][0]
+
+    def run():
+        matrix = contrasts_engine.pivot_results(p.results, 'Symbol', lfc, pval)
+        member = enrichment.membership(p.results, 'Symbol', matrix.genes)
+        return enrichment.enrichment(matrix, member)
+    return run, lambda res: {'rows': len(res), 'significant': int((res['fdr_ora'] < 0.05).sum())}
+
+
+@case('project_concordance')
+def project_concordance(p):
+    lfc, pval = p.config['lfc_col'][0], p.config['pval_col'][0]
+    matrix = contrasts_engine.pivot_results(p.results, 'Name', lfc, pval)
+    # The project compared with itself under two names, every contrast of both
+    matrices = {'a': matrix, 'b': matrix}
+    columns = [(project, con) for project in matrices for con in matrix.contrasts]
+
+    def run():
+        return concordance.concordance(concordance.align(matrices, columns), 1.0, 0.05)
+    return run, lambda res: {'pairs': len(res), 'pearson': _round(res['pearson'].sum(), 4)}
+
+
+@case('expression_gene_plots')
+def expression_gene_plots(p):
+    sample_sheet = p.sample_data.reset_index()
+    samples = list(sample_sheet['sampleID'])
+    genes = list(p.tpms['Symbol'].iloc[::max(len(p.tpms) // 20, 1)][:20])
+    # The search index is built once per project in the app, figures on every rerun
+    search = genesearch.build_index(p.tpms, ['Name', 'Symbol'])
+
+    def run():
+        values = Expression.log_expression(p.tpms, samples)
+        sizes = []
+        for gene in genes:
+            match = search.match(search.search(gene, 1)[0])
+            gene_df = Expression.gene_expression(values[match.rows], gene, 'Symbol', sample_sheet, 'sampleID',
+                                                 'log2 (TPM)')
+            fig = Expression.expression_figure(gene_df, gene, 'Symbol', 'treatment', 'day', 'log2 (TPM)',
+                                               p.sample_data.columns)
+            sizes.append(len(fig.to_json()))
+        return values, sizes
+    return run, lambda out: {'log_sum': _round(out[0].sum(), 2), 'figures': len(out[1])}
+
+
+@case('gene_search')
+def gene_search(p):
+    search = genesearch.build_index(p.tpms, ['Name', 'Symbol'])
+    queries = ['', 'gene', 'gene0001', 'sym12', 'SYM1999', 'gnee00012', 'ym34', 'nothing']
+
+    def run():
+        return [search.search(q, 20) for q in queries * 10]
+    return run, lambda out: {'matches': [len(m) for m in out[:len(queries)]]}
+
+
+@case('process_gmt_parse')
+def gmt_parse(p):
+    gmt_file = next(p.datadir.glob('*.gmt'))
+    return (lambda: process_gmt.proces_gmt(gmt_file, path_name=2)), lambda df: {'pairs': len(df)}
+
+
+@case('process_gmt_join')
+def gmt_join(p):
+    gmt_df = process_gmt.proces_gmt(next(p.datadir.glob('*.gmt')), path_name=2)
+    results = pd.read_csv(next(p.datadir.glob('*_unfiltered_results_ann.csv'))).rename({'Symbol': 'Name'}, axis=1)
+
+    def run():
+        return process_gmt.PathwayIndex(gmt_df).join(results)
+    return run, lambda df: {'rows': len(df), 'annotated': int(df['KEGG_Pathway'].notna().sum())}
+
+
+@case('visualize_filter_all_exps')
+def visualize_filter(p):
+    counts = p.counts
+    return (lambda: visualize.filter_all_exps(counts, 1000)), lambda df: {'rows': len(df)}
+
+
+@case('visualize_gene_lookup')
+def visualize_lookup(p):
+    counts = p.counts
+    genes = counts['ShortName'].unique()[:50]
+
+    def run():
+        # Cold lookups: the per-table cache is dropped before every run
+        visualize._filtered.clear()
+        by_gene = visualize.filtered_by_gene(counts, 0)
+        return [len(by_gene.loc[[g]]) for g in genes]
+    return run, lambda rows: {'rows': int(sum(rows))}
+
+
+def run_cases(project, names, repeat):
+    out = {}
+    for name in names:
+        run, summarize = CASES[name](project)
+        seconds, result = best_of(run, repeat)
+        out[name] = {'seconds': seconds, 'summary': json.loads(json.dumps(summarize(result), default=str))}
+        print(f'{name:28s} {seconds:9.4f}s', flush=True)
+    return out
+
+
+def _same(a, b, rtol=1e-6):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k], rtol) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_same(x, y, rtol) for x, y in zip(a, b))
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return bool(np.isclose(a, b, rtol=rtol, atol=0))
+    return a == b
+
+
+def compare(current, baseline, tolerance):
+    """Print current against baseline, return the names of cases that changed or slowed down."""
+    failed = []
+    print(f'\n{"case":28s} {"baseline":>10s} {"current":>10s} {"ratio":>7s}  result')
+    for name, now in current.items():
+        before = baseline['cases'].get(name)
+        if before is None:
+            print(f'{name:28s} {"-":>10s} {now["seconds"]:9.4f}s {"-":>7s}  new case')
+            continue
+        ratio = now['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        same = _same(now['summary'], before['summary'])
+        status = 'ok' if same else f'CHANGED {before["summary"]} -> {now["summary"]}'
+        if ratio > tolerance:
+            status += ' SLOWER'
+        if not same or ratio > tolerance:
+            failed.append(name)
+        print(f'{name:28s} {before["seconds"]:9.4f}s {now["seconds"]:9.4f}s {ratio:6.2f}x  {status}')
+    return failed
+
+
+def main(args):
+    params = {'genes': args.genes, 'samples': args.samples, 'contrasts': args.contrasts,
+              'pathways': args.pathways, 'barcode_genes': args.barcode_genes, 'seed': args.seed}
+    names = [n for n in CASES if not args.only or any(o in n for o in args.only)]
+    with tempfile.TemporaryDirectory() as tmp:
+        datadir = args.datadir or synthetic.make_bundle(Path(tmp) / 'synthetic', args.genes, args.samples,
+                                                        args.contrasts, args.pathways, args.seed)
+        print(f'{args.genes} genes, {args.samples} samples, {args.contrasts} contrasts, {args.pathways} pathways')
+        current = run_cases(Project(datadir, args.barcode_genes), names, args.repeat)
+
+    if args.save_baseline:
+        record = {'params': params,
+                  'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                                  'pandas': pd.__version__, 'machine': platform.machine()},
+                  'cases': current}
+        args.baseline.write_text(json.dumps(record, indent=2) + '\n')
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    if not args.baseline.exists():
+        # Nothing to compare against is a failure, or a regression would pass unnoticed
+        print(f'No baseline at {args.baseline}, run with --save-baseline to store one')
+        return 1
+    baseline = json.loads(args.baseline.read_text())
+    if baseline['params'] != params:
+        print(f'Baseline was recorded with {baseline["params"]}, not comparable')
+        return 1
+    failed = compare(current, baseline, args.tolerance)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=48)
+    parser.add_argument('--contrasts', type=int, default=6)
+    parser.add_argument('--pathways', type=int, default=300)
+    parser.add_argument('--barcode-genes', type=int, default=2000, help='Genes in the visualize.py count table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='Only run cases whose name contains one of these')
+    parser.add_argument('--datadir', type=Path, help='Use an existing synthetic.py project instead of generating one')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Fail when slower than this times the baseline')
+    sys.exit(main(parser.parse_args()))
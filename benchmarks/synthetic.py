@@ -0,0 +1,148 @@
+"""
+Generate synthetic project bundles with the layout the app expects.
+
+usage: python benchmarks/synthetic.py OUTDIR [--genes 20000] [--samples 48] [--contrasts 6] [--pathways 300] [--archive]
+
+Writes pages.yaml, sampleData.csv, <name>_vsd.csv, <name>_tpms.csv, the DiffAb results with
+and without pathways (<name>_unfiltered_results_ann.csv / .kegg.csv) and the GMT file they
+were annotated from. make_barcode_counts builds the barcode count table used by visualize.py.
+"""
+
+import argparse
+import tarfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+
+ANNOTATION = ['Name', 'Symbol']
+FACTORS = {'treatment': ['control', 'drugA', 'drugB', 'drugC'], 'day': ['d1', 'd3', 'd7']}
+
+
+def _sample_sheet(n_samples, rng):
+    samples = [f'sample{i:04d}' for i in range(n_samples)]
+    sheet = pd.DataFrame({'sampleID': samples})
+    for factor, levels in FACTORS.items():
+        sheet[factor] = np.array(levels)[np.arange(n_samples) % len(levels)]
+    sheet['batch'] = rng.choice(['b1', 'b2'], n_samples)
+    return sheet
+
+
+def _gmt(genes, n_pathways, rng, mean_size=40):
+    """{pathway: member genes}, sizes drawn around mean_size, genes may belong to several pathways."""
+    sizes = np.clip(rng.poisson(mean_size, n_pathways), 3, len(genes))
+    return {f'path{i:05d}:Synthetic pathway {i}': rng.choice(genes, size, replace=False)
+            for i, size in enumerate(sizes)}
+
+
+def make_bundle(outdir, genes=20000, samples=48, contrasts=6, pathways=300, seed=0, name='synthetic'):
+    """
+    Write a synthetic project to outdir and return its path.
+
+    Expression has a per-treatment effect on 5% of the genes, so PCA and the DiffAb
+    filters have structure to find. Results contain every gene in every contrast.
+    """
+    rng = np.random.default_rng(seed)
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    names = np.array([f'gene{i:06d}' for i in range(genes)])
+    symbols = np.array([f'SYM{i}' for i in range(genes)])
+    sheet = _sample_sheet(samples, rng)
+    sheet.to_csv(outdir / 'sampleData.csv', index=False)
+
+    # log-scale expression: gene baseline + treatment effect on a subset of genes + noise
+    treatment_codes = pd.Categorical(sheet.treatment, categories=FACTORS['treatment']).codes
+    baseline = rng.normal(8, 2, genes)
+    effects = np.zeros((genes, len(FACTORS['treatment'])))
+    affected = rng.random(genes) < 0.05
+    effects[affected] = rng.normal(0, 2, (affected.sum(), len(FACTORS['treatment'])))
+    vsd = baseline[:, None] + effects[:, treatment_codes] + rng.normal(0, 0.5, (genes, samples))
+    vsd_df = pd.DataFrame(vsd, columns=sheet.sampleID)
+    vsd_df.insert(0, 'gene', names)
+    vsd_df.to_csv(outdir / f'{name}_vsd.csv', index=False)
+    tpms = pd.DataFrame(np.exp2(vsd - 4), columns=sheet.sampleID)
+    tpms.insert(0, 'Symbol', symbols)
+    tpms.insert(0, 'Name', names)
+    tpms.to_csv(outdir / f'{name}_tpms.csv', index=False)
+
+    contrast_names = [f'contrast{i}_vs_control' for i in range(contrasts)]
+    lfc = rng.normal(0, 0.5, (genes, contrasts)) + np.where(affected[:, None], rng.normal(0, 2, (genes, contrasts)), 0)
+    padj = np.clip(np.exp(-np.abs(lfc) * rng.uniform(1, 6, (genes, contrasts))), 1e-300, 1)
+    results = pd.DataFrame({'Name': np.tile(names, contrasts),
+                            'Symbol': np.tile(symbols, contrasts),
+                            'log2FoldChange': lfc.ravel(order='F'),
+                            'padj': padj.ravel(order='F'),
+                            'contrast': np.repeat(contrast_names, genes)})
+    results.to_csv(outdir / f'{name}_unfiltered_results_ann.csv', index=False)
+
+    gmt = _gmt(symbols, pathways, rng)
+    with open(outdir / f'{name}.gmt', 'w') as fh:
+        for path, members in gmt.items():
+            pid, desc = path.split(':', 1)
+            fh.write('\t'.join([pid, desc, *members]) + '\n')
+    pairs = pd.DataFrame([(g, p) for p, members in gmt.items() for g in members], columns=['Symbol', 'KEGG_Pathway'])
+    results.merge(pairs, on='Symbol', how='left').to_csv(outdir / f'{name}_unfiltered_results_ann.kegg.csv',
+                                                         index=False)
+
+    config = {'projectName': f'Synthetic {genes} genes x {samples} samples',
+              'pages': ['Home', 'EDA', 'DiffAb', 'Expression', 'Pathway'],
+              'annotation': ANNOTATION,
+              'sampleID': ['sampleID'],
+              'lfc_col': ['log2FoldChange'],
+              'pval_col': ['padj']}
+    with open(outdir / 'pages.yaml', 'w') as fh:
+        yaml.safe_dump(config, fh)
+    return outdir
+
+
+def make_barcode_counts(genes=500, barcodes_per_gene=4, experiments=4, mice=6, seed=0):
+    """
+    Long barcode count table as read by visualize.py: every barcode counted in two inoculum
+    samples and in mice x 2 days of each experiment.
+    """
+    rng = np.random.default_rng(seed)
+    n_barcodes = genes * barcodes_per_gene
+    barcodes = np.array([f'bc{i:07d}' for i in range(n_barcodes)])
+    gene_of = np.repeat([f'gene{i:05d}' for i in range(genes)], barcodes_per_gene)
+    frames = []
+    for e in range(experiments):
+        samples = [('inoculum', 'd0', f'exp{e}_inoculum{i}') for i in range(2)]
+        samples += [(f'mouse{m}', day, f'exp{e}_m{m}_{day}') for m in range(mice) for day in ('d1', 'd3')]
+        for mouse, day, sample in samples:
+            frames.append(pd.DataFrame({'barcode': barcodes,
+                                        'sampleID': sample,
+                                        'cnt': rng.negative_binomial(2, 2 / (2 + 1500), n_barcodes),
+                                        'dnaid': f'dna{e // 2}',
+                                        'experiment': f'exp{e}',
+                                        'ShortName': gene_of,
+                                        'locus_tag': gene_of,
+                                        'mouse': mouse,
+                                        'day': day,
+                                        'organ': 'colon'}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def archive(datadir, tar_file=None):
+    """Pack a generated project into a .tar.gz that can be uploaded to the app."""
+    datadir = Path(datadir)
+    tar_file = Path(tar_file or datadir.with_suffix('.tar.gz'))
+    with tarfile.open(tar_file, 'w:gz') as tar:
+        for f in sorted(datadir.iterdir()):
+            tar.add(f, arcname=f'{datadir.name}/{f.name}')
+    return tar_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('outdir')
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=48)
+    parser.add_argument('--contrasts', type=int, default=6)
+    parser.add_argument('--pathways', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive', action='store_true', help='Also write OUTDIR.tar.gz for upload')
+    args = parser.parse_args()
+    out = make_bundle(args.outdir, args.genes, args.samples, args.contrasts, args.pathways, args.seed)
+    if args.archive:
+        print(archive(out))
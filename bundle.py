@@ -0,0 +1,244 @@
+"""
+Extraction cache for uploaded project bundles.
+
+Uploaded tarballs are hashed once and extracted into a per-hash directory under
+the cache root. Later reruns and sessions reuse the extracted tree and the parsed
+``pages.yaml`` instead of going back to the archive. Entries are evicted least
+recently used first once the cache grows past its size limit.
+
+Only the members that the enabled pages read are extracted: ``pages.yaml`` is
+read from the archive first and matched against ``PAGE_INPUTS``. Tables converted
+by ``scripts/convert_bundle.py`` replace their CSVs when they can be read here.
+"""
+
+import fnmatch
+import hashlib
+import importlib.util
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+CACHE_DIR = Path(os.environ.get('MIBIO_CACHE_DIR', Path(tempfile.gettempdir()) / 'mibio_cache'))
+CACHE_MAX_BYTES = int(os.environ.get('MIBIO_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+CHUNK_SIZE = 8 * 1024 ** 2
+
+_ROOT_FILE = '.root'
+_SIZE_FILE = '.size'
+_configs = {}
+MANIFEST = 'columnar.yaml'
+
+# Files (glob patterns relative to the bundle root) read by each page
+PAGE_INPUTS = {'Home': [],
+               'EDA': ['*vsd.csv', 'sampleData.csv', '*unfiltered*results*kegg.csv'],
+               'DiffAb': ['*unfiltered*results*kegg.csv'],
+               'Expression': ['*tpms*.csv', 'sampleData.csv', '*synonyms.tsv'],
+               'Pathway': ['*unfiltered*results*kegg.csv'],
+               'Assembly': ['*report.tsv'],
+               'Comparison': ['*unfiltered*results*kegg.csv']}
+
+
+def hash_upload(fileobj):
+    """Return the sha256 hex digest of a file-like object, read in chunks."""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def _is_safe(member):
+    path = Path(member.name)
+    if path.is_absolute() or '..' in path.parts:
+        return False
+    return member.isfile()
+
+
+def comparison_inputs(page_inputs=None):
+    """Page inputs of a bundle opened for comparison: its results are needed whatever pages it enables."""
+    page_inputs = PAGE_INPUTS if page_inputs is None else page_inputs
+    extra = page_inputs.get('Comparison', [])
+    return {page: sorted(set(patterns) | set(extra)) for page, patterns in page_inputs.items()}
+
+
+def required_patterns(config, page_inputs=None):
+    """Glob patterns for every file read by the pages enabled in config."""
+    page_inputs = PAGE_INPUTS if page_inputs is None else page_inputs
+    patterns = {'pages.yaml'}
+    for page in config['pages']:
+        patterns.update(page_inputs.get(page, []))
+    return sorted(patterns)
+
+
+def _relative_name(member, root):
+    path = Path(member.name)
+    if root != '.':
+        if path.parts[:1] != (root,):
+            return None
+        path = Path(*path.parts[1:])
+    # Pages only look at top-level files of the bundle
+    return path.name if len(path.parts) == 1 else None
+
+
+def columnar_available():
+    """Whether converted .parquet/.feather tables can be read here."""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def readable(entry):
+    """Whether the converted file of a manifest entry can be read here."""
+    return entry['format'] == 'memmap' or columnar_available()
+
+
+def entry_files(entry):
+    """Every file a manifest entry is stored in, sidecars included."""
+    return [entry[k] for k in ('file', 'rows_file', 'cols_file') if k in entry]
+
+
+def select_members(names, patterns, manifest=None):
+    """
+    Pick the files to extract among the top-level names of a bundle.
+
+    CSVs listed in the columnar manifest are swapped for their converted file
+    when it is present and readable, so only one copy of each table is kept.
+    """
+    converted = {k: v for k, v in (manifest or {}).get('files', {}).items() if readable(v)}
+    selected = []
+    for pattern in patterns:
+        sources = {n for n in names if fnmatch.fnmatch(n, pattern)}
+        sources |= {n for n in converted if fnmatch.fnmatch(n, pattern)}
+        for source in sorted(sources):
+            if source in converted and all(f in names for f in entry_files(converted[source])):
+                selected += entry_files(converted[source]) + [MANIFEST]
+            elif source in names:
+                selected.append(source)
+    return set(selected)
+
+
+def iter_members(fileobj, page_inputs=None):
+    """
+    Stream the archive, yielding (name, member, tar) for the files the enabled pages need.
+
+    pages.yaml (and the columnar manifest) are parsed straight from the archive, so
+    nothing else is read into memory or written to disk before the needed members
+    are known. Members must be consumed (e.g. with tar.extractfile) before advancing.
+    """
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj, mode='r:gz') as tar:
+        config_member = None
+        for member in tar:
+            if Path(member.name).name == 'pages.yaml' and len(Path(member.name).parts) <= 2 and _is_safe(member):
+                config_member = member
+                break
+        if config_member is None:
+            raise FileNotFoundError('pages.yaml not found in the uploaded bundle')
+        root = str(Path(config_member.name).parent)
+        config = yaml.safe_load(tar.extractfile(config_member))
+        # Reads the remaining headers only, member contents are not decompressed into memory
+        members = {}
+        for member in tar.getmembers():
+            name = _relative_name(member, root) if _is_safe(member) else None
+            if name:
+                members[name] = member
+        manifest = None
+        if MANIFEST in members:
+            manifest = yaml.safe_load(tar.extractfile(members[MANIFEST]))
+        selected = select_members(members, required_patterns(config, page_inputs), manifest)
+        for name, member in members.items():
+            if name in selected:
+                yield name, member, tar
+
+
+def read_members(fileobj, page_inputs=None):
+    """Load only the members needed by the enabled pages into memory, as {name: bytes}."""
+    return {name: tar.extractfile(member).read() for name, member, tar in iter_members(fileobj, page_inputs)}
+
+
+def _tree_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def _extract(fileobj, entry, page_inputs=None):
+    """Extract the needed members into a temporary directory and move it into place."""
+    tmp = Path(tempfile.mkdtemp(dir=CACHE_DIR, prefix='.tmp-'))
+    try:
+        root = tmp / 'bundle'
+        root.mkdir()
+        for name, member, tar in iter_members(fileobj, page_inputs):
+            with tar.extractfile(member) as src, open(root / name, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        (tmp / _ROOT_FILE).write_text('bundle')
+        (tmp / _SIZE_FILE).write_text(str(_tree_size(tmp)))
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # Another session finished extracting the same bundle first
+            shutil.rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _entry_size(entry):
+    try:
+        return int((entry / _SIZE_FILE).read_text())
+    except (OSError, ValueError):
+        return _tree_size(entry)
+
+
+def evict(max_bytes=None, keep=()):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = [e for e in CACHE_DIR.iterdir() if e.is_dir() and not e.name.startswith('.')]
+    sizes = {e: _entry_size(e) for e in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        if entry.name in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        for key in [k for k in _configs if k.startswith(str(entry))]:
+            del _configs[key]
+        total -= sizes[entry]
+
+
+def load_config(datadir):
+    """Parse pages.yaml once per extracted bundle."""
+    key = str(datadir)
+    if key not in _configs:
+        with open(Path(datadir) / 'pages.yaml') as fh:
+            _configs[key] = yaml.safe_load(fh)
+    return _configs[key]
+
+
+def _inputs_key(page_inputs):
+    spec = repr(sorted((k, sorted(v)) for k, v in page_inputs.items()))
+    return hashlib.sha256(spec.encode()).hexdigest()[:8]
+
+
+def open_bundle(fileobj, digest=None, page_inputs=None):
+    """
+    Return (datadir, config, digest) for an uploaded results tarball.
+
+    :param fileobj: seekable file-like object holding a .tar.gz bundle
+    :param digest: hash of fileobj if already known, skips re-hashing
+    :param page_inputs: {page: [glob patterns]}, defaults to PAGE_INPUTS
+    """
+    page_inputs = PAGE_INPUTS if page_inputs is None else page_inputs
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    digest = digest or hash_upload(fileobj)
+    # What gets extracted depends on the page inputs, so they are part of the key
+    entry = CACHE_DIR / f'{digest}-{_inputs_key(page_inputs)}'
+    if not entry.is_dir():
+        _extract(fileobj, entry, page_inputs)
+        evict(keep=(entry.name,))
+    now = time.time()
+    os.utime(entry, (now, now))
+    datadir = entry / (entry / _ROOT_FILE).read_text()
+    return datadir, load_config(datadir), digest
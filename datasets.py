@@ -0,0 +1,308 @@
+"""
+Session-independent registry of the tables in an extracted project bundle.
+
+Each artifact (config, sample sheet, results table, vsd and TPM matrices) is
+parsed once per bundle with explicit dtypes and shared by every page, rerun and
+session looking at the same bundle. Pages get views of the cached tables and
+must not modify them in place.
+
+Tables converted with ``scripts/convert_bundle.py`` are read from their columnar
+file when it is listed in the manifest, otherwise from the CSV. Either way only
+the columns the pages use are read. Matrices converted to the memmap format are
+also available through ``matrix()`` without being loaded into memory.
+"""
+
+import fnmatch
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+
+import bundle
+import matrixstore
+import profiling
+
+MAX_PROJECTS = 8
+
+# artifact name -> glob pattern of the file it is read from
+ARTIFACTS = {'sample_data': 'sampleData.csv',
+             'results': '*unfiltered*results*kegg.csv',
+             'vsd': '*vsd.csv',
+             'tpms': '*tpms*.csv'}
+# artifacts whose first column is the index
+INDEXED = {'sample_data', 'vsd'}
+
+_registries = OrderedDict()
+_registries_lock = threading.Lock()
+_caches = {}
+
+
+def _readonly_frame(df):
+    """Rebuild an all-numeric frame on top of a read-only float64 array."""
+    values = df.to_numpy(dtype='float64')
+    values.flags.writeable = False
+    return pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
+
+
+def _contrast_bounds(contrasts):
+    """{contrast: (start, stop)} row positions of a categorical column sorted by its codes."""
+    codes = contrasts.cat.codes.to_numpy()
+    categories = np.arange(len(contrasts.cat.categories))
+    starts = np.searchsorted(codes, categories, side='left')
+    stops = np.searchsorted(codes, categories, side='right')
+    return {c: (int(a), int(b)) for c, a, b in zip(contrasts.cat.categories, starts, stops)}
+
+
+def frame_nbytes(obj):
+    """Deep in-memory footprint of a DataFrame, Series or array, 0 for anything else."""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True, index=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True, index=True))
+    if isinstance(obj, matrixstore.MemmapMatrix):
+        # The values are mapped from disk, only the labels are resident
+        return frame_nbytes(obj.labels)
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, (tuple, list)):
+        return sum(frame_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(frame_nbytes(o) for o in obj.values())
+    return 0
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping for derived results that vary with widget values."""
+
+    def __init__(self, maxsize=32, name='cache') -> None:
+        self.maxsize = maxsize
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, func, *args, **kwargs):
+        """Return the cached value for key, computing it with func on a miss."""
+        with self._lock:
+            if key in self._data:
+                return self[key]
+        with profiling.stage(self.name, 'compute'):
+            value = func(*args, **kwargs)
+        self[key] = value
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def nbytes(self):
+        with self._lock:
+            values = list(self._data.values())
+        return frame_nbytes(values)
+
+
+def named_cache(name, maxsize=32):
+    """Return the process-wide LRUCache called name, creating it on first use."""
+    with _registries_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(maxsize, name)
+        return _caches[name]
+
+
+class DatasetRegistry:
+    """Lazily loads and caches the artifacts of one extracted bundle."""
+
+    def __init__(self, datadir) -> None:
+        self.datadir = Path(datadir)
+        self._data = {}
+        self._lock = threading.RLock()
+
+    @property
+    def config(self):
+        return bundle.load_config(self.datadir)
+
+    @property
+    def manifest(self):
+        """Columnar manifest written by scripts/convert_bundle.py, None if absent."""
+        manifest_file = self.datadir / bundle.MANIFEST
+        if not manifest_file.exists():
+            return None
+        return self.derive('manifest', lambda: yaml.safe_load(manifest_file.read_text()))
+
+    def path(self, name):
+        """Path of the CSV backing an artifact."""
+        pattern = ARTIFACTS[name]
+        matches = sorted(self.datadir.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f'No file matching {pattern} in {self.datadir}')
+        return matches[0]
+
+    def columnar(self, name):
+        """Manifest entry of the converted file for an artifact, None if it has to be read from CSV."""
+        manifest = self.manifest
+        if not manifest:
+            return None
+        for source, entry in sorted(manifest['files'].items()):
+            if (fnmatch.fnmatch(source, ARTIFACTS[name]) and bundle.readable(entry)
+                    and all((self.datadir / f).exists() for f in bundle.entry_files(entry))):
+                return entry
+        return None
+
+    def matrix(self, name):
+        """MemmapMatrix of an artifact converted to the memmap format, None otherwise."""
+        entry = self.columnar(name)
+        if entry is None or entry['format'] != 'memmap':
+            return None
+        return self.derive(('matrix', name), matrixstore.MemmapMatrix, self.datadir, entry)
+
+    def has(self, name):
+        """Whether the bundle contains an artifact, as CSV or converted."""
+        return self.columnar(name) is not None or any(self.datadir.glob(ARTIFACTS[name]))
+
+    def key(self, name):
+        """Stable identifier of an artifact, for keying caches of derived results."""
+        return f'{self.datadir}:{name}'
+
+    def read_table(self, name, columns=None, dtype=None):
+        """
+        Read an artifact from its columnar file if there is one, from CSV otherwise.
+
+        :param columns: columns to read (the index is always read), None for all
+        :param dtype: {column: dtype}, applied to numeric and categorical columns of columnar files
+        """
+        dtype = dtype or {}
+        entry = self.columnar(name)
+        if entry is not None:
+            path = self.datadir / entry['file']
+            usecols = [c for c in entry['columns'] if columns is None or c in columns]
+            if entry['format'] == 'memmap':
+                df = self.matrix(name).to_frame()
+                df = df[[c for c in df.columns if c in usecols]]
+            elif entry['format'] == 'parquet':
+                df = pd.read_parquet(path, columns=usecols)
+            else:
+                index = [entry['index']] if entry['index'] else []
+                if name in INDEXED and not index:
+                    raise ValueError(f"{entry['file']} has no index column in {bundle.MANIFEST}, convert it again")
+                df = pd.read_feather(path, columns=index + usecols)
+                if index:
+                    df = df.set_index(index[0])
+            typed = {c: t for c, t in dtype.items() if c in df.columns and t is not str}
+            return df.astype(typed) if typed else df
+        path = self.path(name)
+        header = list(pd.read_csv(path, nrows=0).columns)
+        index_col = 0 if name in INDEXED else None
+        usecols = None
+        if columns is not None:
+            usecols = [c for i, c in enumerate(header) if c in columns or (index_col == 0 and i == 0)]
+        dtype = {c: t for c, t in dtype.items() if c in header}
+        return pd.read_csv(path, index_col=index_col, usecols=usecols, dtype=dtype or None)
+
+    def _load_sample_data(self):
+        df = self.read_table('sample_data')
+        df.index = df.index.astype(str)
+        return df
+
+    def _load_results(self):
+        """
+        Results table in a compact form: gene annotation repeats once per contrast (and pathway),
+        so it is stored as categoricals, LFCs as float32 and log10FDR is added once here.
+        P-values stay float64, float32 underflows to 0 below 1e-38.
+
+        Rows are sorted by contrast so the rows of one contrast are a slice (see contrast_rows).
+        """
+        config = self.config
+        lfc, pval = config['lfc_col'][0], config['pval_col'][0]
+        dtype = {c: 'category' for c in config['annotation']}
+        dtype.update({'contrast': 'category', 'KEGG_Pathway': 'category', lfc: 'float32', pval: 'float64'})
+        df = self.read_table('results', columns=list(dtype), dtype=dtype)
+        with np.errstate(divide='ignore'):
+            df['log10FDR'] = (-10 * np.log10(df[pval])).astype('float32')
+        return df.sort_values('contrast', kind='stable', na_position='first').reset_index(drop=True)
+
+    def _load_vsd(self):
+        df = self.read_table('vsd')
+        df.index = df.index.astype(str)
+        return _readonly_frame(df)
+
+    def _load_tpms(self):
+        annotation = self.config['annotation']
+        samples = list(self.get('sample_data').index)
+        dtype = {c: str for c in annotation}
+        dtype.update({c: 'float64' for c in samples})
+        return self.read_table('tpms', columns=annotation + samples, dtype=dtype)
+
+    def contrast_rows(self, contrast):
+        """Rows of the results table for one contrast, 'All' for every row, as a view rather than a copy."""
+        fdf = self.get('results')
+        if contrast == 'All':
+            return fdf
+        bounds = self.derive('contrast_bounds', _contrast_bounds, fdf['contrast'])
+        start, stop = bounds.get(contrast, (0, 0))
+        return fdf.iloc[start:stop]
+
+    def get(self, name):
+        """Return a view of an artifact, loading it on first use."""
+        with self._lock:
+            if name not in self._data:
+                with profiling.stage(name, 'load'):
+                    self._data[name] = getattr(self, f'_load_{name}')()
+            df = self._data[name]
+        return df.copy(deep=False)
+
+    def derive(self, key, func, *args, **kwargs):
+        """Cache func(*args, **kwargs) under key for the lifetime of this bundle."""
+        with self._lock:
+            if key not in self._data:
+                with profiling.stage(key if isinstance(key, str) else key[0], 'compute'):
+                    self._data[key] = func(*args, **kwargs)
+            return self._data[key]
+
+    def memory_usage(self):
+        """Bytes held by every resident artifact and derived result, indexed by name."""
+        with self._lock:
+            items = list(self._data.items())
+        return pd.Series({str(k): frame_nbytes(v) for k, v in items}, dtype='int64', name='bytes')
+
+
+def get_registry(datadir):
+    """Return the registry shared by all sessions for the bundle in datadir."""
+    key = str(datadir)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = DatasetRegistry(datadir)
+            while len(_registries) > MAX_PROJECTS:
+                _registries.popitem(last=False)
+        _registries.move_to_end(key)
+        return _registries[key]
+
+
+def resident():
+    """Memory held by all registries and named caches, one row per (project, artifact)."""
+    with _registries_lock:
+        registries = list(_registries.items())
+        caches = list(_caches.items())
+    rows = [(project, artifact, nbytes) for project, registry in registries
+            for artifact, nbytes in registry.memory_usage().items()]
+    rows += [('<cache>', name, cache.nbytes()) for name, cache in caches]
+    return pd.DataFrame(rows, columns=['project', 'artifact', 'bytes'])
@@ -0,0 +1,131 @@
+"""
+On-disk float32 matrices with row and column label sidecars.
+
+A matrix is stored as three files next to each other:
+
+- ``<stem>.f32``: the values, raw C-order float32
+- ``<stem>.rows.csv``: the label columns (gene ids, annotation), one line per matrix row
+- ``<stem>.cols.txt``: one column label (sample id) per line
+
+Matrices are opened with ``np.memmap``, so concurrent sessions share the OS page
+cache instead of each holding a pandas copy, and reductions run over row chunks.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 4096
+
+
+def write_matrix(csv_file, label_cols=None, index_col=None, chunk_rows=CHUNK_ROWS):
+    """
+    Stream a CSV into the memmap format without loading it whole, returns its manifest entry.
+
+    :param label_cols: columns kept as row labels, every other numeric column is a value column
+    :param index_col: position of the index column, kept as the only row label
+    """
+    csv_file = Path(csv_file)
+    stem = csv_file.with_suffix('')
+    head = pd.read_csv(csv_file, nrows=100)
+    header = list(head.columns)
+    if index_col is not None:
+        label_cols = [header[index_col]]
+    # Any other non-numeric column (descriptions etc.) is kept with the labels
+    label_cols = [c for c in header if c in (label_cols or []) or not pd.api.types.is_numeric_dtype(head[c])]
+    value_cols = [c for c in header if c not in label_cols]
+    n_rows = 0
+    values_file = stem.with_suffix('.f32')
+    rows_file = stem.with_suffix('.rows.csv')
+    cols_file = stem.with_suffix('.cols.txt')
+    with open(values_file, 'wb') as values_fh, open(rows_file, 'w') as rows_fh:
+        for chunk in pd.read_csv(csv_file, chunksize=chunk_rows, dtype={c: str for c in label_cols}):
+            chunk[value_cols].to_numpy(dtype='float32').tofile(values_fh)
+            chunk[label_cols].to_csv(rows_fh, index=False, header=n_rows == 0)
+            n_rows += len(chunk)
+    cols_file.write_text(''.join(f'{c}\n' for c in value_cols))
+    return {'file': values_file.name,
+            'format': 'memmap',
+            'rows_file': rows_file.name,
+            'cols_file': cols_file.name,
+            'index': label_cols[0] if index_col is not None else None,
+            'rows': n_rows,
+            'columns': label_cols + value_cols,
+            'categorical': []}
+
+
+class MemmapMatrix:
+    """Read-only genes x samples matrix backed by a memory-mapped float32 file."""
+
+    def __init__(self, datadir, entry) -> None:
+        datadir = Path(datadir)
+        self.labels = pd.read_csv(datadir / entry['rows_file'], dtype=str, keep_default_na=False)
+        self.columns = pd.Index((datadir / entry['cols_file']).read_text().splitlines())
+        index_col = entry.get('index') or self.labels.columns[0]
+        self.index = pd.Index(self.labels[index_col])
+        self.index_name = entry.get('index')
+        self.values = np.memmap(datadir / entry['file'], dtype='float32', mode='r',
+                                shape=(len(self.labels), len(self.columns)))
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def iter_chunks(self, chunk_rows=CHUNK_ROWS):
+        """Yield (first row, float64 block) over consecutive row chunks."""
+        for start in range(0, self.shape[0], chunk_rows):
+            yield start, np.asarray(self.values[start:start + chunk_rows], dtype='float64')
+
+    def row_variance(self, ddof=1, chunk_rows=CHUNK_ROWS):
+        """Variance of every row across columns, computed chunk by chunk."""
+        variance = np.empty(self.shape[0])
+        for start, block in self.iter_chunks(chunk_rows):
+            variance[start:start + len(block)] = np.nanvar(block, axis=1, ddof=ddof)
+        return variance
+
+    def column_positions(self, names):
+        """Positions of column names, KeyError for names that are not columns of the matrix."""
+        positions = self.columns.get_indexer(names)
+        if (positions < 0).any():
+            raise KeyError(f'Not in the matrix: {list(pd.Index(names)[positions < 0])}')
+        return positions
+
+    def take(self, rows, columns=None):
+        """
+        Float64 copy of the given row positions (and column positions), read from disk.
+
+        Negative column positions raise IndexError: they are what get_indexer returns for a
+        missing name and would otherwise silently read the last columns.
+        """
+        block = self.values[np.asarray(rows)]
+        if columns is not None:
+            columns = np.asarray(columns)
+            if (columns < 0).any():
+                raise IndexError('Negative column positions, use column_positions to look up names')
+            block = block[:, columns]
+        return block.astype('float64')
+
+    def to_numpy(self, dtype='float64'):
+        return np.asarray(self.values, dtype=dtype)
+
+    def to_frame(self):
+        """Materialize as a DataFrame shaped like the CSV it was converted from."""
+        values = pd.DataFrame(self.to_numpy(), columns=self.columns)
+        if self.index_name:
+            return values.set_axis(self.index.rename(self.index_name), axis=0)
+        return pd.concat([self.labels, values], axis=1)
+
+
+def row_variance(matrix):
+    """Per-row variance of a DataFrame or MemmapMatrix."""
+    if isinstance(matrix, MemmapMatrix):
+        return matrix.row_variance()
+    return np.nanvar(matrix.to_numpy(dtype='float64'), axis=1, ddof=1)
+
+
+def take_rows(matrix, rows):
+    """Float64 values of the given row positions of a DataFrame or MemmapMatrix."""
+    if isinstance(matrix, MemmapMatrix):
+        return matrix.take(rows)
+    return matrix.to_numpy(dtype='float64')[rows]
@@ -4,11 +4,40 @@ Adapted from https://towardsdatascience.com/creating-multipage-applications-usin
 
 This file is the framework for generating multiple Streamlit applications
 through an object oriented framework.
+
+Pages can be given as the module path of their app function ("options.EDA" or
+"options.EDA:app"), in which case the module is only imported when the page is
+first selected. Import times are recorded in IMPORT_METRICS.
+
+Every page run is profiled (see profiling.py).
 """
 
 
+import importlib
+import logging
+import sys
+import time
+
 import streamlit as st
 
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# module path -> seconds spent importing it, shared by all sessions of this process
+IMPORT_METRICS = {}
+
+
+def load_page(path):
+    """Import the module of a page path and return its app function, timing the first import."""
+    module_name, _, attr = path.partition(':')
+    if module_name not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(module_name)
+        IMPORT_METRICS[module_name] = time.perf_counter() - start
+        logger.info('Imported page %s in %.3fs', module_name, IMPORT_METRICS[module_name])
+    return getattr(sys.modules[module_name], attr or 'app')
+
 
 class MultiPage:
     """Framework for combining multiple streamlit applications."""
@@ -16,13 +45,15 @@ class MultiPage:
     def __init__(self) -> None:
         """Constructor class to generate a list which will store all our applications as an instance variable."""
         self.pages = []
+        profiling.install()
 
     def add_page(self, title, func, data_dir) -> None:
         """Class Method to Add pages to the project
         Args:
             title ([str]): The title of page which we are adding to the list of apps
 
-            func: Python function to render this page in Streamlit
+            func: Python function to render this page in Streamlit, or the module path of
+                that function ("options.EDA" or "options.EDA:app") to import it lazily
         """
 
         self.pages.append({
@@ -40,5 +71,19 @@ class MultiPage:
             format_func=lambda page: page['title']
         )
 
-        # run the app function
-        page['function'](page['data_dir'])
\ No newline at end of file
+        profile = profiling.current() or profiling.begin()
+        profile.label = page['title']
+        profile.meta['project'] = str(page['data_dir'])
+        try:
+            # run the app function, importing its module on first use
+            func = page['function']
+            if isinstance(func, str):
+                with profiling.stage(func, 'load'):
+                    func = load_page(func)
+            func(page['data_dir'])
+        finally:
+            # Also reached when the page calls st.stop()
+            profile = profiling.finish()
+            logger.debug('Page %s ran in %.3fs', profile.label, profile.total)
+            if profiling.panel_enabled():
+                profiling.render_panel(profile)
@@ -1,57 +1,62 @@
 import streamlit as st
 import pandas as pd
-from sklearn.decomposition import PCA
-import numpy as np
 import plotly.express as px
 
+import datasets
+import profiling
+
+# QUAST/Unicycler reports read from the bundle, metrics in rows and one column per assembly
+REPORTS = ['*unicycler*report.tsv', 'report.tsv', 'contigs_report.tsv']
+STATS = ['# contigs', 'Largest contig', 'Total length', 'GC (%)', 'N50', 'L50']
+REFERENCE_STATS = ['# misassemblies', 'Misassembled contigs length', '# local misassemblies', 'Genome fraction (%)',
+                   "# N's per 100 kbp", "# mismatches per 100 kbp"]
+
+
+def load_reports(datadir):
+    """All assembly reports in datadir as one assemblies x metrics table."""
+    reports = [pd.read_table(f, index_col=0) for pattern in REPORTS for f in sorted(datadir.glob(pattern))]
+    if not reports:
+        return None
+    # Side by side on the metric names, each report adds its assemblies
+    df = pd.concat([r[~r.index.duplicated()] for r in reports], axis=1)
+    # Assemblies in more than one report are combined, taking the first value of each metric
+    df = df.T.groupby(level=0, sort=False).first()
+    df.index.name = 'sampleID'
+    return df
+
+
+@profiling.timed('figure')
+def stats_figure(df, stats, columns=2):
+    """One bar chart per statistic, as small multiples of a single figure. None without stats."""
+    if not stats:
+        return None
+    long = (df[stats].apply(pd.to_numeric, errors='coerce').reset_index()
+            .melt(id_vars='sampleID', var_name='stat', value_name='value'))
+    rows = -(-len(stats) // columns)
+    fig = px.bar(long, x='sampleID', y='value', facet_col='stat', facet_col_wrap=columns,
+                 facet_row_spacing=0.3 / rows, facet_col_spacing=0.06, height=300 * rows,
+                 category_orders={'stat': stats}, labels={'value': '', 'sampleID': ''})
+    fig.update_yaxes(matches=None, showticklabels=True)
+    fig.update_xaxes(showticklabels=df.shape[0] <= 30)
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split('=', 1)[-1]))
+    fig.update_layout(autosize=True, font=dict(size=16), paper_bgcolor='rgba(0,0,0,0)')
+    return fig
+
 
 def app(datadir):
-    st.write(datadir)
     st.write('# Assembly Stats')
-    st.write('## Statistics for contigs >= 500 bp')
-    # Input standart report file
-    df1 = pd.read_table("/Users/ansintsova/git_repos/tnseq_app/data/assembly_test/unicycler.report.tsv")
-    df2 = pd.read_table("/Users/ansintsova/git_repos/tnseq_app/data/assembly_test/report.tsv")
-    df3 = pd.read_table("/Users/ansintsova/git_repos/tnseq_app/data/assembly_test/contigs_report.tsv")
-    df = df1.merge(df2, on='Assembly').merge(df3, on='Assembly').set_index("Assembly").T
-    stats_to_show = ['# contigs', 'Largest contig', 'Total length', 'GC (%)', 'N50', 'L50']
-    stats_to_show = [s for s in stats_to_show if s in df.columns]
-
-    df_all = df[stats_to_show].copy().astype(float).reset_index().rename({'index':'sampleID'}, axis=1)
-    c1, c2 = st.columns(2)
-    for i, stat in enumerate(stats_to_show):
-        f = px.bar(df_all, x='sampleID', y=stat, width=400,
-                                         color='sampleID', hover_data=df_all)
-        f.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
-                          )
-        f.update_xaxes(showticklabels=False)
-        if df_all.sampleID.nunique() < 4:
-            if i%2 == 0:
-                c2.plotly_chart(f,use_container_width=True)
-            else:
-                c1.plotly_chart(f, use_container_width=True)
-        else:
-            st.plotly_chart(f, use_container_width=True)
-
-    if_ref = ['# misassemblies', 'Misassembled contigs length', '# local misassemblies', 'Genome fraction (%)',
-              "# N's per 100 kbp", "# mismatches per 100 kbp"]
-    if_ref = [s for s in if_ref if s in df.columns]
+    data = datasets.get_registry(datadir)
+    df = data.derive('assembly_reports', load_reports, datadir)
+    if df is None:
+        st.write('No QUAST or Unicycler reports found in this project')
+        st.stop()
+    stats_to_show = [s for s in STATS if s in df.columns]
+    if len(stats_to_show) > 0:
+        st.write('## Statistics for contigs >= 500 bp')
+        st.plotly_chart(stats_figure(df, stats_to_show), use_container_width=True)
+
+    if_ref = [s for s in REFERENCE_STATS if s in df.columns]
     if len(if_ref) > 0:
         st.write("## Reference-based stats")
-        c3, c4 = st.columns(2)
-        df_ref = df[if_ref].copy().astype(float).reset_index().rename({'index': 'sampleID'}, axis=1)
-        for i, stat in enumerate(if_ref):
-            f = px.bar(df_ref, x='sampleID', y=stat, width=400,
-                       color='sampleID', hover_data=df_ref)
-            f.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
-                            )
-            f.update_xaxes(showticklabels=False)
-            if df_ref.sampleID.nunique() < 4:
-                if i % 2 == 0:
-                    c3.plotly_chart(f, use_container_width=True)
-                else:
-                    c4.plotly_chart(f, use_container_width=True)
-            else:
-                st.plotly_chart(f, use_container_width=True)
-    st.write(df.T)
-
+        st.plotly_chart(stats_figure(df, if_ref), use_container_width=True)
+    st.dataframe(df.T)
@@ -0,0 +1,124 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly.express as px
+
+import datasets
+import profiling
+from options import plotting
+from options import concordance
+from options import contrasts as contrasts_engine
+from options import export
+
+_aligned_cache = datasets.named_cache('project_alignment', maxsize=16)
+
+
+def project_labels(registries):
+    """Project names for display, prefixed with the upload position so the same bundle twice stays two projects."""
+    return [f"{i + 1}: {data.config.get('projectName', data.datadir.name)}" for i, data in enumerate(registries)]
+
+
+def column_label(column):
+    project, contrast = column
+    return f'{project}: {contrast}'
+
+
+def load_matrix(data, gene_name):
+    """
+    Gene x contrast LFC and padj of a project, reading only the four columns needed
+    rather than loading the whole results table.
+    """
+    config = data.config
+    lfc, pval = config['lfc_col'][0], config['pval_col'][0]
+    dtype = {gene_name: 'category', 'contrast': 'category', lfc: 'float32', pval: 'float64'}
+    fdf = data.read_table('results', columns=list(dtype), dtype=dtype)
+    return contrasts_engine.pivot_results(fdf, gene_name, lfc, pval)
+
+
+def scatter_figure(aligned, x, y, gene_name, lfc_th, fdr, webgl_min_points=plotting.WEBGL_MIN_POINTS):
+    """LFC of one aligned column against another, genes coloured by the columns they are hits in."""
+    clrs = px.colors.qualitative.Plotly
+    i, j = aligned.columns.index(x), aligned.columns.index(y)
+    hits = concordance.hit_matrix(aligned, lfc_th, fdr)
+    x_label, y_label = column_label(x), column_label(y)
+    df = pd.DataFrame({gene_name: aligned.genes, x_label: aligned.lfc[:, i], y_label: aligned.lfc[:, j],
+                       'hit': np.select([hits[:, i] & hits[:, j], hits[:, i], hits[:, j]],
+                                        ['both', 'x only', 'y only'], 'neither')}).dropna()
+    if len(df) > webgl_min_points:
+        df['hit'] = df['hit'] != 'neither'
+        fig = plotting.dense_scatter(df, x_label, y_label, 'hit', gene_name, colors=(clrs[0], clrs[1]))
+    else:
+        fig = px.scatter(df, x=x_label, y=y_label, color='hit', hover_name=gene_name,
+                         color_discrete_map={'neither': clrs[0], 'both': clrs[1], 'x only': clrs[2],
+                                             'y only': clrs[3]})
+    lim = np.nanmax(np.abs(df[[x_label, y_label]].to_numpy())) if len(df) else 1
+    fig.add_shape(type='line', x0=-lim, y0=-lim, x1=lim, y1=lim, line=dict(color='grey', dash='dash'))
+    fig.add_hline(y=0, line_width=1, line_color="grey")
+    fig.add_vline(x=0, line_width=1, line_color="grey")
+    fig.update_layout(autosize=True, height=700, font=dict(size=16), paper_bgcolor='rgba(0,0,0,0)')
+    return fig
+
+
+def app(datadirs):
+    st.write('## Compare Projects')
+    registries = [datasets.get_registry(d) for d in datadirs]
+    registries = [data for data in registries if data.has('results')]
+    if len(registries) < 2:
+        st.info('Upload at least two projects with DiffAb results to compare them.')
+        st.stop()
+    labels = project_labels(registries)
+    annotation = [c for c in registries[0].config['annotation']
+                  if all(c in data.config['annotation'] for data in registries[1:])]
+    if not annotation:
+        st.error('The projects have no gene annotation column in common.')
+        st.stop()
+    gene_name = st.radio('Join projects on', annotation, key='cmp_ann')
+    # Same cache key as DiffAb and Pathway, a project opened there is not pivoted again
+    matrices = {label: data.derive(('contrast_matrix', gene_name), load_matrix, data, gene_name)
+                for label, data in zip(labels, registries)}
+
+    options = [(label, con) for label, matrix in matrices.items() for con in matrix.contrasts]
+    columns = st.multiselect('Contrasts to compare', options, format_func=column_label,
+                             default=[(label, matrix.contrasts[0]) for label, matrix in matrices.items()
+                                      if matrix.contrasts])
+    if len(columns) < 2:
+        st.stop()
+    c1, c2, c3 = st.columns(3)
+    how_labels = {'inner': 'Genes in every project', 'outer': 'Genes in any project'}
+    how = c1.radio('Genes', list(how_labels), format_func=how_labels.get, key='cmp_how')
+    fdr = c2.number_input('FDR cutoff', value=0.05, key='cmp_fdr')
+    lfc_th = c3.number_input('Log FC cutoff (absolute)', min_value=0.0, step=0.5, value=1.0, key='cmp_lfc')
+    keys = tuple(data.key('results') for data in registries)
+    aligned = _aligned_cache.get((keys, gene_name, tuple(columns), how), concordance.align,
+                                 matrices, columns, how)
+    st.write(f'{len(aligned.genes)} genes aligned on {gene_name}')
+
+    with st.expander('LFC scatter', expanded=True):
+        c1, c2 = st.columns(2)
+        x = c1.selectbox('x', columns, index=0, format_func=column_label, key='cmp_x')
+        y = c2.selectbox('y', columns, index=1, format_func=column_label, key='cmp_y')
+        with profiling.stage('comparison_scatter', 'figure'):
+            fig = scatter_figure(aligned, x, y, gene_name, lfc_th, fdr,
+                                 registries[0].config.get('webgl_min_points', plotting.WEBGL_MIN_POINTS))
+        st.plotly_chart(fig, use_container_width=True)
+
+    with st.expander('Concordance', expanded=True):
+        with profiling.stage('concordance', 'compute'):
+            table = concordance.concordance(aligned, lfc_th, fdr)
+            r, _ = concordance.correlation_matrix(aligned.lfc)
+        names = [column_label(c) for c in columns]
+        with profiling.stage('correlation_heatmap', 'figure'):
+            fig = px.imshow(pd.DataFrame(r, index=names, columns=names), zmin=-1, zmax=1,
+                            color_continuous_scale='RdBu_r', labels={'color': 'Pearson r'},
+                            height=max(400, 40 * len(names)))
+            fig.update_layout(autosize=True, font=dict(size=14), paper_bgcolor='rgba(0,0,0,0)')
+        st.plotly_chart(fig, use_container_width=True)
+        st.dataframe(table)
+
+    with st.expander('Download aligned table'):
+        fmt = st.selectbox('Format', export.available_formats(), key='cmp_fmt')
+        ext, mime, _ = export.FORMATS[fmt]
+        path = export.export_table((keys, gene_name, tuple(columns), how),
+                                   lambda: concordance.aligned_frame(aligned, gene_name), fmt)
+        with open(path, 'rb') as fh:
+            st.download_button(f"Download data as {ext} file", fh, file_name=f'project_comparison.{ext}', mime=mime)
@@ -1,13 +1,19 @@
 import streamlit as st
-from pathlib import Path
 import pandas as pd
 import numpy as np
 import plotly.express as px
 from itertools import cycle
-import yaml
-import requests
-from time import sleep
+from concurrent import futures
 
+import datasets
+import profiling
+from options import plotting
+from options import contrasts as contrasts_engine
+from options import string_client
+from options import export
+
+# Seconds a rerun waits for a STRING query before showing it as still running
+STRING_WAIT = 1.0
 
 
 def load_data(design_file, count_file):
@@ -15,91 +21,150 @@ def load_data(design_file, count_file):
     countData = pd.read_csv((count_file), index_col=0)
     return sampleData, countData
 
-@st.cache
-def convert_df(df):
- # IMPORTANT: Cache the conversion to prevent computation on every rerun
-    return df.to_csv().encode('utf-8')
 
+def hit_mask(df, lfc, pval, lfc_th, fdr):
+    """Boolean Series of the rows above the absolute LFC cutoff and below the FDR cutoff."""
+    return (df[lfc].abs() > lfc_th) & (df[pval] < fdr)
 
-def app(datadir):
-    clrs = px.colors.qualitative.Plotly
-    st.write('## Differentical Expression Results')
 
-    fdf = pd.read_csv(list(datadir.glob("*unfiltered*results*kegg.csv"))[0])
-    c1, c2, c3, c4 = st.columns(4)
+def plot_table(df, lfc, pval, gene_name, lfc_th, fdr):
+    """The columns of a results table a figure needs, with its hit column. The table itself is left as is."""
+    return df[[gene_name, lfc, pval, 'log10FDR']].assign(hit=hit_mask(df, lfc, pval, lfc_th, fdr))
 
-    with open(datadir / "pages.yaml") as fh:
-        config = yaml.safe_load(fh)
-    annotation_cols = config['annotation']
-    sampleID = config['sampleID'][0]
-    pval = config['pval_col'][0]
-    lfc = config['lfc_col'][0]
-    gene_name = st.radio('Choose gene annotation', annotation_cols, key='ann')
-    contrast_col = 'contrast'
-    contrasts = fdf[contrast_col].unique()
-    contrast_to_show = st.selectbox('Select a contrast', ['All'] + list(contrasts))
-    fdf['log10FDR'] = -10 * np.log10(fdf[pval])
-    if contrast_to_show == 'All':
-        df = fdf.copy()
+
+def volcano_figure(df, lfc, pval, gene_name, fdr, lfc_th, webgl_min_points=plotting.WEBGL_MIN_POINTS):
+    """
+    Volcano plot of a results table with a log10FDR column.
+
+    :param fdr: FDR cutoff, drawn as a horizontal line
+    :param lfc_th: absolute LFC cutoff, drawn as vertical lines
+    """
+    clrs = px.colors.qualitative.Plotly
+    df = plot_table(df, lfc, pval, gene_name, lfc_th, fdr)
+    dense = len(df) > webgl_min_points
+    if dense:
+        fig = plotting.dense_scatter(df, lfc, 'log10FDR', 'hit', gene_name, [pval], colors=(clrs[0], clrs[1]))
+        fig.update_layout(height=700)
     else:
-        df = fdf[fdf[contrast_col] == contrast_to_show].copy()
-    with st.expander('Show Volcano Plot'):
-        c1, c2 = st.columns(2)
-        fdr = c1.number_input('FDR cutoff', value=0.05)
-        lfc_th = c2.number_input('Log FC cutoff (absolute)', value=1)
-        df['hit'] = ((abs(df[lfc]) > lfc_th) & (df[pval] < fdr))
         fig = px.scatter(df, x=lfc, y='log10FDR', color='hit',
                          height=700,
                          color_discrete_map={
                              True: clrs[1],
                              False: clrs[0]},
                          hover_name=df[gene_name], hover_data=[lfc, pval])
-        fig.add_vline(x=lfc_th, line_width=2, line_dash="dash", line_color="grey")
-        fig.add_vline(x=-lfc_th, line_width=2, line_dash="dash", line_color="grey")
-        fig.add_hline(y=-10*np.log10(fdr), line_width=2, line_dash="dash", line_color="grey")
-        fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
-                          )
+    fig.add_vline(x=lfc_th, line_width=2, line_dash="dash", line_color="grey")
+    fig.add_vline(x=-lfc_th, line_width=2, line_dash="dash", line_color="grey")
+    fig.add_hline(y=-10*np.log10(fdr), line_width=2, line_dash="dash", line_color="grey")
+    fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
+                      )
+    if not dense:
         fig.update_traces(marker=dict(size=8,
                                       line=dict(width=1,
                                                 color='DarkSlateGrey')),
                           selector=dict(mode='markers'))
-        st.plotly_chart(fig, use_container_width=True)
+    return fig
 
-    with st.expander('LFC rankings by Pathway'):
-        lfc_col, fdr_col = st.columns(2)
-        fdr = fdr_col.number_input('FDR cutoff', value=0.05, key='kegg_pval')
-        lfc_th = lfc_col.number_input('Log FC cutoff (absolute)', min_value=0.0, step=0.5, value=1.0,key='kegg_lfc')
-        df['hit'] = ((abs(df[lfc]) > lfc_th) & (df[pval] < fdr))
-        show_kegg = st.selectbox('Show KEGG Pathway', ['All'] + list(df.KEGG_Pathway.unique()))
-        if show_kegg != 'All':
-            df = df[df.KEGG_Pathway == show_kegg]
-        df = df.sort_values(lfc).reset_index().reset_index().rename({'level_0': 'ranking'}, axis=1)
+
+def ranking_figure(df, lfc, pval, gene_name, fdr, lfc_th, title, webgl_min_points=plotting.WEBGL_MIN_POINTS):
+    """Genes of a results table with a log10FDR column ordered by LFC, hits coloured."""
+    clrs = px.colors.qualitative.Plotly
+    df = plot_table(df, lfc, pval, gene_name, lfc_th, fdr).sort_values(lfc)
+    df.insert(0, 'ranking', np.arange(len(df)))
+    dense = len(df) > webgl_min_points
+    if dense:
+        fig = plotting.dense_scatter(df, 'ranking', lfc, 'hit', gene_name, [pval], colors=(clrs[0], clrs[1]))
+        fig.update_layout(height=700, title=title, xaxis_title='', yaxis_title='Log2 FC')
+    else:
         fig = px.scatter(df, x='ranking', y=lfc, color='hit',
                          height=700,
                          color_discrete_map={
                              True: clrs[1],
                              False: clrs[0]},
                          hover_name=gene_name,
-                         title=f"{contrast_to_show} - {show_kegg}",
+                         title=title,
                          hover_data={lfc: True,
                                      'log10FDR': False,
                                     'ranking': False,
                                      pval: True},
                          labels={"ranking": '', lfc: 'Log2 FC'}
                          )
-        fig.add_hline(y=0, line_width=2, line_dash="dash", line_color="grey")
-        fig.update_xaxes(showticklabels=False)
-        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
-                          font=dict(size=18))
+    fig.add_hline(y=0, line_width=2, line_dash="dash", line_color="grey")
+    fig.update_xaxes(showticklabels=False)
+    fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
+                      font=dict(size=18))
+    if not dense:
         fig.update_traces(marker=dict(size=14,
                                       line=dict(width=2,
                                                 color='DarkSlateGrey')),
                           selector=dict(mode='markers'))
+    return fig
+
+
+def app(datadir):
+    st.write('## Differentical Expression Results')
+
+    data = datasets.get_registry(datadir)
+    fdf = data.get('results')
+    c1, c2, c3, c4 = st.columns(4)
+
+    config = data.config
+    annotation_cols = config['annotation']
+    sampleID = config['sampleID'][0]
+    pval = config['pval_col'][0]
+    lfc = config['lfc_col'][0]
+    # Scatters with more points than this switch to WebGL with a binned density layer
+    webgl_min_points = config.get('webgl_min_points', plotting.WEBGL_MIN_POINTS)
+    gene_name = st.radio('Choose gene annotation', annotation_cols, key='ann')
+    contrast_col = 'contrast'
+    contrasts = fdf[contrast_col].unique()
+    contrast_to_show = st.selectbox('Select a contrast', ['All'] + list(contrasts))
+    # A slice of the shared table, sections below only ever filter it further
+    df = data.contrast_rows(contrast_to_show)
+    with st.expander('Show Volcano Plot'):
+        c1, c2 = st.columns(2)
+        fdr = c1.number_input('FDR cutoff', value=0.05)
+        lfc_th = c2.number_input('Log FC cutoff (absolute)', value=1)
+        with profiling.stage('volcano', 'figure'):
+            fig = volcano_figure(df, lfc, pval, gene_name, fdr, lfc_th, webgl_min_points)
         st.plotly_chart(fig, use_container_width=True)
 
+    with st.expander('LFC rankings by Pathway'):
+        lfc_col, fdr_col = st.columns(2)
+        fdr = fdr_col.number_input('FDR cutoff', value=0.05, key='kegg_pval')
+        lfc_th = lfc_col.number_input('Log FC cutoff (absolute)', min_value=0.0, step=0.5, value=1.0,key='kegg_lfc')
+        show_kegg = st.selectbox('Show KEGG Pathway', ['All'] + list(df.KEGG_Pathway.unique()))
+        if show_kegg != 'All':
+            df = df[df.KEGG_Pathway == show_kegg]
+        with profiling.stage('lfc_ranking', 'figure'):
+            fig = ranking_figure(df, lfc, pval, gene_name, fdr, lfc_th, f"{contrast_to_show} - {show_kegg}",
+                                 webgl_min_points)
+        st.plotly_chart(fig, use_container_width=True)
+
+    with st.expander('Download hits of all contrasts'):
+        c1, c2, c3 = st.columns(3)
+        fdr = c1.number_input('FDR cutoff', value=0.05, key='bulk_fdr')
+        lfc_th = c2.number_input('Log FC cutoff (absolute)', min_value=0.0, step=0.5, value=1.0, key='bulk_lfc')
+        fmt = c3.selectbox('Format', export.available_formats(), key='bulk_fmt')
+
+        def hit_lists():
+            hits = fdf[hit_mask(fdf, lfc, pval, lfc_th, fdr)]
+            for con, hit_df in hits.groupby(contrast_col, sort=True, observed=True):
+                yield str(con), hit_df[[gene_name, lfc, pval, contrast_col]].sort_values(pval)
+
+        # Only written once asked for, the flag keeps the download button until a cutoff changes
+        archive_key = (data.key('results'), gene_name, fdr, lfc_th)
+        if st.button('Prepare archive', key='bulk_prepare'):
+            st.session_state['bulk_archive'] = (archive_key, fmt)
+        if st.session_state.get('bulk_archive') == (archive_key, fmt):
+            archive = export.export_archive(archive_key, hit_lists, fmt)
+            with open(archive, 'rb') as fh:
+                st.download_button('Download hit lists (zip)', fh, mime='application/zip',
+                                   file_name=f"{config['projectName'].replace(' ', '_')}_hits.zip")
+
     st.subheader("Protein-protein interactions")
     with st.expander('Tabular Results'):
-        vennDf = fdf.copy()
+        matrix = data.derive(('contrast_matrix', gene_name), contrasts_engine.pivot_results,
+                             fdf, gene_name, lfc, pval, contrast_col)
         compContrasts = st.multiselect('Select contrasts to display', contrasts)
         c1, c2 = st.columns(2)
         filters = {}
@@ -107,50 +172,64 @@ def app(datadir):
             col.write(con)
             l = col.number_input('LFC cutoff', value=-1.0, step=0.5, key=f'{con}_lfc')
             f = col.number_input('FDR cutoff', value=0.05, step=0.01, key=f'{con}_fdr')
-            filters[con] = (l, f)
-        comp_genes = []
-
-        for key, value in filters.items():
-            if value[0] > 0:
-                genes = set(vennDf[(vennDf[contrast_col] == key) & (vennDf[lfc] > value[0])
-                                   & (vennDf[pval] < value[1])][gene_name].values)
-            else:
-                genes = set(vennDf[(vennDf[contrast_col] == key) & (vennDf[lfc] < value[0])
-                                   & (vennDf[pval] < value[1])][gene_name].values)
-            comp_genes.append(genes)
-        if not comp_genes:
+            filters[str(con)] = (l, f)
+        if not filters:
             st.stop()
-        intersect_genes = set.intersection(*comp_genes)
-        vennDf = vennDf[vennDf[gene_name].isin(intersect_genes)].copy()
+        how_labels = {'all': 'Pass all filters', 'any': 'Pass any filter', 'at_least': 'Pass at least k filters'}
+        how = st.radio('Combine filters', list(how_labels), format_func=how_labels.get)
+        k = 1
+        if how == 'at_least':
+            k = st.slider('k', min_value=1, max_value=len(filters), value=1)
+        selected_genes, regions = contrasts_engine.select_genes(matrix, filters, how, k)
+        st.write('Genes in each combination of passed filters')
+        st.dataframe(regions)
+        vennDf = fdf[fdf[gene_name].isin(selected_genes)]
         vennDf = vennDf[[gene_name, lfc, pval, contrast_col]].drop_duplicates()
         #vennDf2 = vennDf.pivot(index='Name', columns='contrast_col', values=['LFC', 'fdr'])
         st.write(vennDf.shape)
         string_col, download_col = st.columns(2)
-        string_api_url = "https://version-11-5.string-db.org/api"
-        output_format = 'tsv-no-header'
-        method = 'get_link'
-        my_genes = set(vennDf[gene_name].values)
-        request_url = "/".join([string_api_url, output_format, method])
+        my_genes = set(vennDf[gene_name].astype(str).values)
         string_col.markdown("### STRING Interaction Network")
         species = string_col.number_input("NCBI species taxid", value=7227, help='Drosophila melanogaster: 7227')
-
-        params = {
-            "identifiers": "\r".join(my_genes),  # your protein
-            "species": species,  # species NCBI identifier
-            "network_flavor": "confidence",  # show confidence links
-            "caller_identity": "mibio"  # your app name
-        }
-    #
-        if string_col.button('Get STRING network'):
-            results = requests.post(request_url, data=params)
-            network_url = results.text.strip()
-            st.markdown(f"[Link to STRING network]({network_url})")
-            sleep(1)
-        download_col.markdown("### Download results as csv")
+        # Queries run on a background thread and are kept in the session, so a rerun never waits
+        # for STRING longer than STRING_WAIT; the link shows on the first rerun after it arrives
+        client = string_client.get_client()
+        link_slot = string_col.empty()
+        query = client.key(my_genes, species)
+        network_url = client.cached(my_genes, species)
+        future = None
+        if network_url is None:
+            pending = st.session_state.get('string_future')
+            if pending is not None and pending[0] == query:
+                future = pending[1]
+            elif string_col.button('Get STRING network'):
+                future = client.submit(my_genes, species)
+                st.session_state['string_future'] = (query, future)
+        download_col.markdown("### Download results")
         fname_default = config['projectName'].replace(' ', '_')
         fname = download_col.text_input("File name", value=fname_default)
-        fname = fname+".csv"
-        download_col.download_button("Download data as csv file", convert_df(vennDf), file_name=fname)
+        fmt = download_col.selectbox('Format', export.available_formats())
+        ext, mime, _ = export.FORMATS[fmt]
+        # Keyed on the filters rather than the table, so reruns reuse the written file
+        table_key = (data.key('results'), gene_name, tuple(filters.items()), how, k)
+        path = export.export_table(table_key, lambda: vennDf, fmt)
+        with open(path, 'rb') as fh:
+            download_col.download_button(f"Download data as {ext} file", fh, file_name=f'{fname}.{ext}', mime=mime)
+        if future is not None:
+            with string_col:
+                with st.spinner('Fetching STRING network'):
+                    futures.wait([future], timeout=STRING_WAIT)
+            if not future.done():
+                link_slot.info('Still fetching the STRING network')
+                string_col.button('Refresh', key='string_refresh')
+            else:
+                del st.session_state['string_future']
+                try:
+                    network_url = future.result()
+                except Exception as e:
+                    link_slot.error(f'STRING request failed: {e}')
+        if network_url:
+            link_slot.markdown(f"[Link to STRING network]({network_url})")
 
     # st.subheader("Gene Selector")
     # with st.expander('Gene Selector'):
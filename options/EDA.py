@@ -1,43 +1,193 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from sklearn.decomposition import PCA
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
 import plotly.express as px
 
 from pathlib import Path
 
+import datasets
+import matrixstore
+import profiling
+from options import plotting
 
-def find_PCs(countData, sampleData, numPCs=2, numGenes=None, choose_by='variance'):
+
+# Above this many matrix cells PCA switches to a randomized SVD of the leading components
+RANDOMIZED_MIN_SIZE = 2_000_000
+RANDOMIZED_COMPONENTS = 20
+
+_pca_cache = datasets.named_cache('pca', maxsize=32)
+
+# Label: metric passed to sample_distances
+DISTANCE_METRICS = {'Pearson correlation': 'pearson', 'Spearman correlation': 'spearman', 'Euclidean': 'euclidean'}
+_cluster_cache = datasets.named_cache('sample_clustering', maxsize=16)
+
+
+def variance_order(countData, key=None):
+    """
+    Row positions of countData ordered by decreasing variance across samples.
+
+    :param key: identifies countData (e.g. DatasetRegistry.key), the ordering is memoized under it
+    """
+    def order():
+        return np.argsort(-matrixstore.row_variance(countData), kind='stable')
+    if key is None:
+        return order()
+    return _pca_cache.get(('order', key), order)
+
+
+def fit_PCs(X, numPCs):
+    """
+    PCA scores and explained variance ratios of X (samples x genes).
+
+    Small matrices are decomposed fully so any number of components can be sliced
+    from one fit. Large ones only get their leading components from a randomized SVD.
+    """
+    maxComponents = min(X.shape)
+    if X.size > RANDOMIZED_MIN_SIZE and numPCs < maxComponents:
+        pca = PCA(n_components=min(max(numPCs, RANDOMIZED_COMPONENTS), maxComponents - 1),
+                  svd_solver='randomized', random_state=0)
+    else:
+        pca = PCA(n_components=maxComponents, svd_solver='full')
+    return pca.fit_transform(X), pca.explained_variance_ratio_
+
+
+MAX_LFC = 'Max across contrasts'
+
+
+def lfc_order(results, countData, gene_col, lfc, contrast_col='contrast'):
+    """
+    Row positions of countData ordered by decreasing absolute LFC, for each contrast
+    and for the maximum across contrasts. Genes without an LFC are left out.
+
+    :param results: long DiffAb results table, one row per gene and contrast
+    :param gene_col: column of results matching the index of countData
+    :return: {contrast or MAX_LFC: array of row positions}
     """
-    :param countData: each column is a sampleID, index is featureID
+    abs_lfc = (results[[gene_col, contrast_col]].assign(abs_lfc=results[lfc].abs())
+               .groupby([gene_col, contrast_col], observed=True)['abs_lfc'].max()
+               .unstack(contrast_col))
+    abs_lfc.index = abs_lfc.index.astype(str)
+    abs_lfc.columns = abs_lfc.columns.astype(str)
+    abs_lfc = abs_lfc.reindex(countData.index)
+    values = np.column_stack([abs_lfc.to_numpy(dtype='float64'), abs_lfc.max(axis=1).to_numpy(dtype='float64')])
+    orders = {}
+    for i, contrast in enumerate(list(abs_lfc.columns) + [MAX_LFC]):
+        # NaNs sort last, so the genes with an LFC are a prefix of the ordering
+        orders[contrast] = np.argsort(-values[:, i], kind='stable')[:np.isfinite(values[:, i]).sum()]
+    return orders
+
+
+@profiling.timed('compute')
+def find_PCs(countData, sampleData, numPCs=2, numGenes=None, choose_by='variance', key=None,
+             lfc_orders=None, contrast=MAX_LFC):
+    """
+    :param countData: each column is a sampleID, index is featureID (DataFrame or MemmapMatrix)
     :param sampleData:
     :param numPCs:
     :param numGenes:
+    :param choose_by: 'variance' or 'log2FoldChange'
+    :param key: identifies countData, fits and gene orderings are cached under it
+    :param lfc_orders: output of lfc_order, needed when choosing by log2FoldChange
+    :param contrast: contrast to rank LFCs in, or MAX_LFC
     :return:
     """
     if numGenes:
         # calculate var for each, pick numGenes top var across samples -> df
         if choose_by == 'variance':
-            genes = countData.var(axis=1).sort_values(ascending=False).head(numGenes).index
-            df = countData.loc[genes].T
+            rows = variance_order(countData, key)[:numGenes]
         else:
-            pass
-            # todo implement log2fc selection
+            rows = lfc_orders[contrast][:numGenes]
     else:
-        df = countData.T
-    pca = PCA(n_components=numPCs)
-    principalComponents = pca.fit_transform(df)
+        rows = np.arange(countData.shape[0])
+        choose_by = contrast = None
+    fit_key = (key, choose_by, contrast if choose_by == 'log2FoldChange' else None, len(rows))
+    if key is not None and fit_key in _pca_cache and _pca_cache[fit_key][0].shape[1] >= numPCs:
+        scores, ratios = _pca_cache[fit_key]
+    else:
+        X = matrixstore.take_rows(countData, rows).T
+        scores, ratios = fit_PCs(X, numPCs)
+        if key is not None:
+            _pca_cache[fit_key] = scores, ratios
     pcs = [f'PC{i}' for i in range(1, numPCs+1)]
-    pDf = (pd.DataFrame(data=principalComponents, columns=pcs)
-           .set_index(df.index))
-    pc_var = {pcs[i]: round(pca.explained_variance_ratio_[i] * 100, 2) for i in range(0, numPCs)}
+    pDf = pd.DataFrame(data=scores[:, :numPCs], columns=pcs, index=countData.columns)
+    pc_var = {pcs[i]: round(ratios[i] * 100, 2) for i in range(0, numPCs)}
     pDf2 = pDf.merge(sampleData, left_index=True, right_index=True)
     return pDf2, pc_var
 
 
+def sample_distances(X, metric='pearson'):
+    """
+    Samples x samples distances between the columns of X (genes x samples), from a single
+    matrix product. Correlation metrics give 1 - r, undefined correlations count as 0.
+    """
+    X = np.asarray(X, dtype='float64')
+    if metric == 'spearman':
+        X = pd.DataFrame(X).rank(axis=0).to_numpy()
+    if metric in ('pearson', 'spearman'):
+        Z = X - X.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            Z /= np.linalg.norm(Z, axis=0)
+        dist = 1 - np.nan_to_num(Z.T @ Z)
+    elif metric == 'euclidean':
+        sq = np.einsum('ij,ij->j', X, X)
+        dist = np.sqrt(np.clip(sq[:, None] + sq[None, :] - 2 * (X.T @ X), 0, None))
+    else:
+        raise ValueError(f'Unknown metric {metric}')
+    # Rounding can leave small negative values and a non-zero diagonal
+    dist = np.clip((dist + dist.T) / 2, 0, None)
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+def cluster_samples(countData, numGenes=None, metric='pearson', key=None, method='average'):
+    """
+    Sample distances on the numGenes most variable genes and their hierarchical clustering.
+
+    :param key: identifies countData, results are cached under (key, numGenes, metric, method)
+    :return: samples x samples distance array, scipy linkage matrix
+    """
+    def compute():
+        rows = variance_order(countData, key)[:numGenes] if numGenes else np.arange(countData.shape[0])
+        dist = sample_distances(matrixstore.take_rows(countData, rows), metric)
+        return dist, hierarchy.linkage(squareform(dist, checks=False), method=method)
+    if key is None:
+        return compute()
+    return _cluster_cache.get((key, numGenes, metric, method), compute)
+
+
+def pca_figure(pDf, pc_var, pcX='PC1', pcY='PC2', pcVar=None, hover_cols=()):
+    """Scatter of two principal components from find_PCs, coloured by the sample column pcVar."""
+    fig = px.scatter(pDf, x=pcX, y=pcY, color=pcVar,
+                     labels ={pcX: f'{pcX}, {pc_var[pcX]} % Variance',
+                              pcY: f'{pcY}, {pc_var[pcY]} % Variance'},
+                     height=700, hover_data=list(hover_cols), hover_name=pDf.index)
+    fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
+                      )
+    fig.update_traces(marker=dict(size=12,
+                                  line=dict(width=2,
+                                            color='DarkSlateGrey')),
+                      selector=dict(mode='markers'))
+    return fig
+
+
 def app(datadir):
     st.write('## PCA')
-    sampleData = pd.read_csv(datadir/"sampleData.csv", index_col=0)
-    countData = pd.read_csv(list(datadir.glob("*vsd.csv"))[0], index_col=0)
+    data = datasets.get_registry(datadir)
+    sampleData = data.get('sample_data')
+    # Converted matrices are read from disk in chunks instead of being loaded whole
+    countData = data.matrix('vsd')
+    if countData is None:
+        countData = data.get('vsd')
+    lfc_orders = None
+    if data.has('results'):
+        config = data.config
+        results = data.get('results')
+        gene_col = next((c for c in config['annotation'] if results[c].isin(countData.index).any()), None)
+        if gene_col:
+            lfc_orders = data.derive('lfc_order', lfc_order, results, countData, gene_col, config['lfc_col'][0])
 
     with st.expander('Show PCA'):
         c1, c2 = st.columns((4, 1))
@@ -45,23 +195,19 @@ def app(datadir):
         maxComponents = min(countData.shape[0], countData.shape[1])
         numPCs = c2.slider("Select number of Principal Components", min_value=2, max_value=maxComponents, value=2)
         numGenes = c2.slider("Number of genes to use", value=500, max_value=countData.shape[0])
-        choose_by = c2.selectbox('Choose genes based on highest', ['variance', 'log2FoldChange (not implemented)'])
-        pDf, pc_var = find_PCs(countData, sampleData, numPCs, numGenes, choose_by)
+        choose_by = c2.selectbox('Choose genes based on highest', ['variance', 'log2FoldChange'] if lfc_orders else ['variance'])
+        contrast = MAX_LFC
+        if choose_by == 'log2FoldChange':
+            contrast = c2.selectbox('Contrast', list(lfc_orders), index=len(lfc_orders) - 1)
+        pDf, pc_var = find_PCs(countData, sampleData, numPCs, numGenes, choose_by, key=data.key('vsd'),
+                               lfc_orders=lfc_orders, contrast=contrast)
         pcX_labels = [f'PC{i}' for i in range(1, numPCs+1)]
         expVars = [c for c in pDf.columns if c not in pcX_labels]
         pcX = c2.selectbox('X-axis component', pcX_labels)
         pcY = c2.selectbox('Y-axis component', [pc for pc in pcX_labels if pc != pcX])
         pcVar = c2.radio('Variable to highlight', expVars)
-        fig = px.scatter(pDf, x=pcX, y=pcY, color=pcVar,
-                         labels ={pcX: f'{pcX}, {pc_var[pcX]} % Variance',
-                                  pcY: f'{pcY}, {pc_var[pcY]} % Variance'},
-                         height=700, hover_data=expVars, hover_name=pDf.index)
-        fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
-                          )
-        fig.update_traces(marker=dict(size=12,
-                                      line=dict(width=2,
-                                                color='DarkSlateGrey')),
-                          selector=dict(mode='markers'))
+        with profiling.stage('pca_scatter', 'figure'):
+            fig = pca_figure(pDf, pc_var, pcX, pcY, pcVar, expVars)
         c1.write(f'### {pcX} vs {pcY}, highlighting {pcVar}')
         c1.plotly_chart(fig, use_container_width=True)
         c3, c4 = st.columns(2)
@@ -78,4 +224,18 @@ def app(datadir):
         c4.write(f'### PCs summarized by {pcVar}')
         c4.plotly_chart(px.imshow(pDf_sum), use_container_width=True)
 
+    with st.expander('Show sample distances'):
+        c1, c2 = st.columns((4, 1))
+        c2.write('### Clustering Options')
+        c2.write(f'On the {numGenes} most variable genes')
+        metric = c2.selectbox('Distance', list(DISTANCE_METRICS))
+        annotate_by = c2.selectbox('Annotate samples by', list(sampleData.columns))
+        # Cached per gene subset and metric, changing the annotation only redraws the figure
+        dist, links = cluster_samples(countData, numGenes, DISTANCE_METRICS[metric], key=data.key('vsd'))
+        with profiling.stage('sample_distances', 'figure'):
+            fig = plotting.clustered_heatmap(dist, list(countData.columns), links, sampleData[annotate_by],
+                                             value_name='1 - r' if 'correlation' in metric else 'distance')
+            fig.update_layout(height=800, autosize=True, font=dict(size=14), paper_bgcolor='rgba(0,0,0,0)')
+        c1.plotly_chart(fig, use_container_width=True)
+
 
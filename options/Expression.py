@@ -4,46 +4,85 @@ import pandas as pd
 import numpy as np
 from itertools import cycle
 import plotly.express as px
-import yaml
+
+import datasets
+import profiling
+from options import genesearch
+
+# Matches offered for a search, the selected genes are always kept as options as well
+SEARCH_RESULTS = 20
+
+
+def log_expression(countData, samples):
+    """log2(TPM + 0.5) of the sample columns as a genes x samples array."""
+    return np.log2(countData[samples].to_numpy(dtype='float64') + 0.5)
+
+
+def gene_expression(values, gene, gene_name, sampleInfo, sampleID, value_name):
+    """
+    Long table of one gene's expression with the sample annotation attached.
+
+    :param values: rows x samples array of the gene's log expression
+    :param sampleInfo: sample sheet with sampleID as a column, in the column order of values
+    """
+    gene_df = pd.concat([sampleInfo] * len(values), ignore_index=True)
+    gene_df.insert(0, gene_name, gene)
+    gene_df[value_name] = values.ravel()
+    return gene_df
+
+
+def expression_figure(gene_df, gene, gene_name, compare_by, color_by, value_name, hover_cols=()):
+    """Box plot of one gene's expression, from gene_expression."""
+    fig = px.box(gene_df.sort_values(compare_by), title=gene, x=compare_by, y=value_name, color=color_by,
+                 hover_data=[gene_name] + list(hover_cols))
+    fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
+                      font=dict(size=16))
+    fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='LightGrey')
+    return fig
 
 
 def app(datadir):
     st.subheader('Gene Expression')
-    with open(datadir / "pages.yaml") as fh:
-        config = yaml.safe_load(fh)
+    data = datasets.get_registry(datadir)
+    config = data.config
 
     clrs = px.colors.qualitative.Plotly
-    sampleData = pd.read_csv(datadir / "sampleData.csv", index_col=0)
-    countData = pd.read_csv(list(datadir.glob("*tpms*.csv"))[0])
+    sampleData = data.get('sample_data')
+    # Converted matrices stay on disk, only the rows of selected genes are read
+    matrix = data.matrix('tpms')
+    countData = data.get('tpms') if matrix is None else matrix.labels
     annotation_cols =config['annotation']
     sampleID = config['sampleID'][0]
-    gene_name = st.radio('Choose gene annotation', annotation_cols)
+    synonym_file = next(datadir.glob('*synonyms.tsv'), None)
 
     with st.expander('Show Gene Expression'):
-        df = countData.set_index(gene_name).copy()
-        df = df.apply(lambda x: np.log2(x + 0.5) if np.issubdtype(x.dtype, np.number) else x)
         sampleDataAb = sampleData.reset_index()
-        df = df.reset_index()
+        samples = list(sampleDataAb[sampleID].values)
+        if matrix is None:
+            logData = data.derive('log_tpms', log_expression, countData, samples)
+            fetch = lambda rows: logData[rows]
+        else:
+            columns = matrix.column_positions(samples)
+            fetch = lambda rows: np.log2(matrix.take(rows, columns) + 0.5)
+        search = data.derive('gene_search', genesearch.build_index, countData, annotation_cols, synonym_file)
         c1, c2 = st.columns(2)
         compare_by = c1.selectbox('Compare by', sampleDataAb.columns)
         color_by = c2.selectbox('Color by',  list(sampleDataAb.columns))
-        genes = st.multiselect("Choose gene(s) of interest", df[gene_name].unique())
+        # Only the top matches of the query are sent to the browser, not every gene name
+        query = st.text_input('Search genes', key='expr_query',
+                              help=f"Names in {', '.join(annotation_cols)}"
+                                   f"{' or their synonyms' if synonym_file else ''}")
+        selected = st.session_state.get('expr_genes', [])
+        options = list(dict.fromkeys(selected + search.search(query, SEARCH_RESULTS)))
+        genes = st.multiselect("Choose gene(s) of interest", options, key='expr_genes')
 
         if not genes:
             st.stop()
         c3, c4 = st.columns(2)
         tpm_label = 'log2 (TPM)'
-        for col, gene in zip(cycle([c3, c4]), genes):
-            gene_df = df[df[gene_name] == gene]
-            samples = list(sampleDataAb[sampleID].values)
-            gene_df = gene_df[[gene_name] + samples]
-
-            gene_df = (gene_df.melt(id_vars=[gene_name], value_name=tpm_label, var_name=sampleID)
-                       .merge(sampleData, how='left', on=sampleID))
-            gene_df = gene_df.sort_values(compare_by)
-            fig = px.box(gene_df, title=gene, x=compare_by, y=tpm_label, color=color_by,
-                           hover_data=[gene_name] + list(sampleData.columns))
-            fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
-                              font=dict(size=16))
-            fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='LightGrey')
+        for col, label in zip(cycle([c3, c4]), genes):
+            gene, gene_name, rows = search.match(label)[1:]
+            gene_df = gene_expression(fetch(rows), gene, gene_name, sampleDataAb, sampleID, tpm_label)
+            with profiling.stage(gene, 'figure'):
+                fig = expression_figure(gene_df, gene, gene_name, compare_by, color_by, tpm_label, sampleData.columns)
             col.plotly_chart(fig, use_container_width=True)
@@ -1,14 +1,16 @@
 import streamlit as st
-import yaml
+
+import datasets
 
 def app(datadir):
 
     descriptions = {'EDA': ['EDA', 'Explore patterns and identify outliers'],
                     'DiffAb': ['Differential Expression', 'Explore diffrential expresion results produced by DESeq2'],
-                    'Expression': ['Gene Expression', 'Explore expression levels for any gene of interest']}
+                    'Expression': ['Gene Expression', 'Explore expression levels for any gene of interest'],
+                    'Pathway': ['Pathway Analysis', 'Find pathways enriched in differentially expressed genes across all contrasts'],
+                    'Assembly': ['Assembly', 'Compare QUAST/Unicycler assembly statistics across samples']}
 
-    with open(datadir / "pages.yaml") as fh:
-        config = yaml.safe_load(fh)
+    config = datasets.get_registry(datadir).config
 
     st.header(config['projectName'])
     for page in config['pages']:
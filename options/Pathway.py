@@ -1,49 +1,82 @@
-# import escher
-# from escher import Builder
-# import streamlit as st
-# import streamlit.components.v1 as components
-# import pandas as pd
-# import numpy as np
-# import plotly.express as px
-#
-# def app(datadir):
-#     st.write('Pathway test')
-#     clrs = px.colors.qualitative.Plotly
-#     fdf = pd.read_csv("/Users/ansintsova/git_repos/fly_rnaseq/data/results_for_app/Test_Control_unfiltered_results_ann.kegg.csv")
-#     fdf['logpval'] = -10 * np.log10(fdf.padj)
-#     fdf['logpval'] = fdf['logpval'].fillna(0.1)
-#     fdf['hits'] = fdf.padj < 0.05
-#     pathways = fdf.KEGG_Pathway.dropna().unique()
-#     p = st.selectbox('Choose Pathway', pathways)
-#     #d = st.selectbox('Choose day', days)
-#     subDf = fdf[(fdf.KEGG_Pathway == p)].sort_values('log2FoldChange')
-#     fig = px.scatter(subDf, x='Symbol', y='log2FoldChange', size='logpval',
-#                      category_orders={"Symbol": subDf.Symbol.values},
-#                      color_discrete_map={
-#                          True: clrs[1],
-#                          False: clrs[0]},
-#                      labels={'Name': '', 'z-score': 'Gene LFC'},
-#                      height=700,
-#                      color='hits')
-#     fig.add_hline(y=0, line_width=2, line_dash="dash", line_color="grey",
-#                   )
-#     fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)',
-#                       )
-#     fig.update_traces(marker=dict(
-#                                   line=dict(width=2,
-#                                             color='DarkSlateGrey')),
-#                       selector=dict(mode='markers'))
-#     st.plotly_chart(fig, use_container_width=True)
-#
-#     # gene_info = pd.read_csv('./data/SL1344_test/Path/S6_RNA-seq_aerobic_to_anaerobic.csv', index_col=0).to_dict()['lfc']
-#     # #gene_info = {"xapA": 7.387150687875563, "xapB": 7.5306018918703765, "speF": 8.340221502890024}
-#     # builder = Builder(
-#     #     map_name= 'iJO1366.Central metabolism',
-#     #     #model_name='e_coli_core',
-#     #
-#     # )
-#     # builder.gene_info = gene_info
-#     # builder.save_html('./data/example_map.html')
-#     # HtmlFile = open("./data/example_map.html", 'r', encoding='utf-8')
-#     # source_code = HtmlFile.read()
-#     # components.html(source_code, height=800)
\ No newline at end of file
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly.express as px
+
+import datasets
+import profiling
+from options import contrasts as contrasts_engine
+from options import enrichment
+
+_enrichment_cache = datasets.named_cache('enrichment', maxsize=16)
+
+
+def app(datadir):
+    st.write('## Pathway Analysis')
+    clrs = px.colors.qualitative.Plotly
+    data = datasets.get_registry(datadir)
+    config = data.config
+    fdf = data.get('results')
+    pval = config['pval_col'][0]
+    lfc = config['lfc_col'][0]
+    contrast_col = 'contrast'
+    gene_name = st.radio('Choose gene annotation', config['annotation'], key='path_ann')
+
+    matrix = data.derive(('contrast_matrix', gene_name), contrasts_engine.pivot_results,
+                         fdf, gene_name, lfc, pval, contrast_col)
+    member = data.derive(('pathway_membership', gene_name), enrichment.membership, fdf, gene_name, matrix.genes)
+
+    c1, c2, c3 = st.columns(3)
+    fdr = c1.number_input('FDR cutoff', value=0.05, key='path_fdr')
+    lfc_th = c2.number_input('Log FC cutoff (absolute)', min_value=0.0, step=0.5, value=1.0, key='path_lfc')
+    min_size = c3.number_input('Minimum pathway size', min_value=1, value=5, step=1)
+    # Every pathway x contrast is tested at once, so browsing only reruns when a threshold changes
+    res = _enrichment_cache.get((data.key('results'), gene_name, fdr, lfc_th, min_size), enrichment.enrichment,
+                                matrix, member, lfc_th, fdr, min_size)
+
+    with st.expander('Enrichment across contrasts', expanded=True):
+        c1, c2 = st.columns(2)
+        method = c1.radio('Test', ['Over-representation', 'Rank-based'])
+        top_n = c2.slider('Number of pathways to show', min_value=5, max_value=100, value=30)
+        fdr_col = 'fdr_ora' if method == 'Over-representation' else 'fdr_rank'
+        scores = res.assign(score=-np.log10(res[fdr_col].clip(lower=1e-300)))
+        if method == 'Rank-based':
+            # Signed by direction, positive when pathway genes have higher LFCs
+            scores['score'] = scores['score'] * np.sign(scores['z_rank'])
+        heat = scores.pivot(index='pathway', columns=contrast_col, values='score')
+        top = scores.groupby('pathway')[fdr_col].min().nsmallest(top_n).index
+        with profiling.stage('enrichment_heatmap', 'figure'):
+            fig = px.imshow(heat.loc[top], aspect='auto', height=max(400, 20 * len(top)),
+                            color_continuous_scale='RdBu_r' if method == 'Rank-based' else 'Reds',
+                            color_continuous_midpoint=0 if method == 'Rank-based' else None,
+                            labels={'color': '-log10 FDR'})
+            fig.update_layout(autosize=True, font=dict(size=14), paper_bgcolor='rgba(0,0,0,0)')
+        st.plotly_chart(fig, use_container_width=True)
+        contrast_to_show = st.selectbox('Select a contrast', ['All'] + list(matrix.contrasts), key='path_contrast')
+        table = res if contrast_to_show == 'All' else res[res[contrast_col] == contrast_to_show]
+        st.dataframe(table.sort_values(fdr_col).reset_index(drop=True))
+
+    with st.expander('Genes in a pathway'):
+        c1, c2 = st.columns(2)
+        p = c1.selectbox('Choose Pathway', list(member.pathways))
+        contrast = c2.selectbox('Choose contrast', list(matrix.contrasts), key='path_gene_contrast')
+        genes = matrix.genes[member.matrix[:, member.pathways.get_loc(p)].nonzero()[0]]
+        j = matrix.contrasts.index(contrast)
+        rows = matrix.genes.get_indexer(genes)
+        subDf = pd.DataFrame({gene_name: genes, lfc: matrix.lfc[rows, j], pval: matrix.padj[rows, j]}).dropna()
+        subDf['logpval'] = -10 * np.log10(subDf[pval].clip(lower=1e-300))
+        subDf['hits'] = (subDf[pval] < fdr) & (subDf[lfc].abs() > lfc_th)
+        subDf = subDf.sort_values(lfc)
+        fig = px.scatter(subDf, x=gene_name, y=lfc, size='logpval',
+                         category_orders={gene_name: list(subDf[gene_name])},
+                         color_discrete_map={
+                             True: clrs[1],
+                             False: clrs[0]},
+                         labels={gene_name: '', lfc: 'Gene LFC'},
+                         height=700,
+                         color='hits')
+        fig.add_hline(y=0, line_width=2, line_dash="dash", line_color="grey")
+        fig.update_layout(autosize=True, font=dict(size=18), paper_bgcolor='rgba(0,0,0,0)')
+        fig.update_traces(marker=dict(line=dict(width=2, color='DarkSlateGrey')),
+                          selector=dict(mode='markers'))
+        st.plotly_chart(fig, use_container_width=True)
@@ -0,0 +1,104 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+Aligned = namedtuple('Aligned', ['genes', 'columns', 'lfc', 'padj'])
+
+
+def shared_genes(indexes, how='inner'):
+    """
+    Genes of several unique Indexes: in every one of them ('inner') or in any ('outer').
+    Inner joins keep the order of the first Index, each lookup probes the hash table of the other.
+    """
+    genes = indexes[0]
+    for other in indexes[1:]:
+        if how == 'inner':
+            genes = genes[other.get_indexer(genes) >= 0]
+        elif how == 'outer':
+            genes = genes.append(other[genes.get_indexer(other) < 0])
+        else:
+            raise ValueError(f'Unknown join {how}')
+    return genes
+
+
+def align(matrices, columns, how='inner'):
+    """
+    Join contrasts of several projects on their gene key.
+
+    :param matrices: {project: ContrastMatrix} from contrasts.pivot_results
+    :param columns: [(project, contrast)] to align, in column order
+    :param how: 'inner' keeps genes of every project, 'outer' of any, missing values are NaN
+    """
+    projects = list(dict.fromkeys(project for project, _ in columns))
+    genes = shared_genes([matrices[p].genes for p in projects], how)
+    rows = {p: matrices[p].genes.get_indexer(genes) for p in projects}
+    lfc = np.full((len(genes), len(columns)), np.nan)
+    padj = np.full((len(genes), len(columns)), np.nan)
+    for i, (project, contrast) in enumerate(columns):
+        matrix, found = matrices[project], rows[project] >= 0
+        j = matrix.contrasts.index(contrast)
+        lfc[found, i] = matrix.lfc[rows[project][found], j]
+        padj[found, i] = matrix.padj[rows[project][found], j]
+    return Aligned(genes, list(columns), lfc, padj)
+
+
+def hit_matrix(aligned, lfc_th=1.0, fdr=0.05):
+    """Boolean gene x column mask of genes above the absolute LFC cutoff and below the FDR cutoff."""
+    with np.errstate(invalid='ignore'):
+        return (np.abs(aligned.lfc) > lfc_th) & (aligned.padj < fdr)
+
+
+def correlation_matrix(values):
+    """
+    Pearson correlation of every pair of columns over the rows where both are finite,
+    with the number of those rows, as two square arrays.
+    """
+    finite = np.isfinite(values).astype('float64')
+    x = np.where(finite > 0, values, 0)
+    n = finite.T @ finite
+    # sums over the rows shared with each other column: s[i, j] = sum of column i where j is finite
+    s = x.T @ finite
+    ss = (x * x).T @ finite
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = x.T @ x - s * s.T / n
+        var = ss - s * s / n
+        r = cov / np.sqrt(var * var.T)
+    return np.clip(r, -1, 1), n.astype(np.int64)
+
+
+def concordance(aligned, lfc_th=1.0, fdr=0.05):
+    """
+    Agreement of every pair of aligned columns, computed for all pairs at once.
+
+    One row per pair: genes measured in both, Pearson and Spearman correlation of their LFCs
+    (Spearman ranks each column over its own genes), the fraction of genes changing in the
+    same direction, hits in each and in both, and the fraction of shared hits in the same direction.
+    """
+    lfc = aligned.lfc
+    finite = np.isfinite(lfc)
+    pearson, n = correlation_matrix(lfc)
+    spearman, _ = correlation_matrix(pd.DataFrame(lfc).rank().to_numpy())
+    up, down = (finite & (lfc > 0)).astype(np.int64), (finite & (lfc < 0)).astype(np.int64)
+    hits = hit_matrix(aligned, lfc_th, fdr)
+    hit_up, hit_down = (hits & (lfc > 0)).astype(np.int64), (hits & (lfc < 0)).astype(np.int64)
+    shared = hits.astype(np.int64).T @ hits.astype(np.int64)
+    same_hits = hit_up.T @ hit_up + hit_down.T @ hit_down
+    same_sign = up.T @ up + down.T @ down
+    i, j = np.triu_indices(len(aligned.columns), 1)
+    labels = np.array([f'{project}: {contrast}' for project, contrast in aligned.columns], dtype=object)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({'x': labels[i], 'y': labels[j],
+                             'genes': n[i, j], 'pearson': pearson[i, j], 'spearman': spearman[i, j],
+                             'same_direction': same_sign[i, j] / n[i, j],
+                             'hits_x': np.diag(shared)[i], 'hits_y': np.diag(shared)[j], 'shared_hits': shared[i, j],
+                             'hit_concordance': same_hits[i, j] / shared[i, j]})
+
+
+def aligned_frame(aligned, gene_name):
+    """Wide table of aligned LFCs and padj, one row per gene."""
+    df = pd.DataFrame({gene_name: aligned.genes})
+    for k, (project, contrast) in enumerate(aligned.columns):
+        df[f'{project}: {contrast} LFC'] = aligned.lfc[:, k]
+        df[f'{project}: {contrast} padj'] = aligned.padj[:, k]
+    return df
@@ -0,0 +1,92 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+ContrastMatrix = namedtuple('ContrastMatrix', ['genes', 'contrasts', 'lfc', 'padj', 'repeated'])
+# Rows of genes appearing more than once in a contrast, other than their most significant one,
+# as gene and contrast positions in the matrix
+RepeatedRows = namedtuple('RepeatedRows', ['genes', 'contrasts', 'lfc', 'padj'])
+
+
+def pivot_results(fdf, gene_name, lfc, pval, contrast_col='contrast'):
+    """
+    Pivot the long results table into gene x contrast LFC and padj arrays.
+
+    When a gene appears more than once in a contrast (a shared symbol, several libraries),
+    the arrays hold its most significant row and the other rows are kept in repeated, so
+    filter_mask passes the gene when any of its rows passes.
+    """
+    df = fdf[[gene_name, contrast_col, lfc, pval]].dropna(subset=[gene_name]).reset_index(drop=True)
+    best = df.sort_values(pval, na_position='last').drop_duplicates([gene_name, contrast_col])
+    genes, gene_codes = np.unique(best[gene_name].astype(str).to_numpy(), return_inverse=True)
+    contrasts, contrast_codes = np.unique(best[contrast_col].astype(str).to_numpy(), return_inverse=True)
+    lfc_values = np.full((len(genes), len(contrasts)), np.nan)
+    padj_values = np.full((len(genes), len(contrasts)), np.nan)
+    lfc_values[gene_codes, contrast_codes] = best[lfc].to_numpy(dtype='float64')
+    padj_values[gene_codes, contrast_codes] = best[pval].to_numpy(dtype='float64')
+    genes, contrasts = pd.Index(genes), list(contrasts)
+    rest = df.drop(index=best.index)
+    repeated = RepeatedRows(genes.get_indexer(rest[gene_name].astype(str)),
+                            pd.Index(contrasts).get_indexer(rest[contrast_col].astype(str)),
+                            rest[lfc].to_numpy(dtype='float64'), rest[pval].to_numpy(dtype='float64'))
+    return ContrastMatrix(genes, contrasts, lfc_values, padj_values, repeated)
+
+
+def _passes(lfc_values, padj_values, lfc_cut, fdr_cut):
+    with np.errstate(invalid='ignore'):
+        passed = np.where(lfc_cut > 0, lfc_values > lfc_cut, lfc_values < lfc_cut)
+        return passed & (padj_values < fdr_cut)
+
+
+def filter_mask(matrix, filters):
+    """
+    Boolean gene x contrast mask for {contrast: (lfc_cutoff, fdr_cutoff)}.
+
+    A positive LFC cutoff keeps genes above it, zero or negative keeps genes below it.
+    Columns follow the order of filters. A gene with several rows in a contrast passes
+    when any of its rows does.
+    """
+    idx = [matrix.contrasts.index(c) for c in filters]
+    lfc_cut = np.array([v[0] for v in filters.values()], dtype='float64')
+    fdr_cut = np.array([v[1] for v in filters.values()], dtype='float64')
+    mask = _passes(matrix.lfc[:, idx], matrix.padj[:, idx], lfc_cut, fdr_cut)
+    repeated = matrix.repeated
+    # filter column of each repeated row, -1 for contrasts not filtered on
+    column = np.full(len(matrix.contrasts), -1)
+    column[idx] = np.arange(len(idx))
+    k = column[repeated.contrasts]
+    passed = (k >= 0) & _passes(repeated.lfc, repeated.padj, lfc_cut[k], fdr_cut[k])
+    mask[repeated.genes[passed], k[passed]] = True
+    return mask
+
+
+def combine(mask, how='all', k=1):
+    """Reduce a gene x contrast mask to genes passing 'all', 'any' or 'at least k' of the filters."""
+    if how == 'all':
+        return mask.all(axis=1)
+    if how == 'any':
+        return mask.any(axis=1)
+    if how == 'at_least':
+        return mask.sum(axis=1) >= k
+    raise ValueError(f'Unknown combination {how}')
+
+
+def region_counts(mask, contrasts):
+    """
+    Number of genes in every Venn/UpSet region, i.e. for every combination of passed filters.
+    Genes passing no filter are not counted.
+    """
+    if mask.shape[1] > 62:
+        raise ValueError('Too many contrasts to encode regions')
+    codes = mask.astype(np.int64) @ (np.int64(1) << np.arange(mask.shape[1], dtype=np.int64))
+    codes, counts = np.unique(codes[codes > 0], return_counts=True)
+    regions = pd.DataFrame(((codes[:, None] >> np.arange(mask.shape[1])) & 1).astype(bool), columns=list(contrasts))
+    regions['genes'] = counts
+    return regions.sort_values('genes', ascending=False).reset_index(drop=True)
+
+
+def select_genes(matrix, filters, how='all', k=1):
+    """Genes passing the filters combined with how, and the region counts of the selected contrasts."""
+    mask = filter_mask(matrix, filters)
+    return matrix.genes[combine(mask, how, k)], region_counts(mask, filters)
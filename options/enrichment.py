@@ -0,0 +1,113 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+
+Membership = namedtuple('Membership', ['pathways', 'matrix'])
+
+
+def membership(fdf, gene_name, genes, pathway_col='KEGG_Pathway', sep=';'):
+    """
+    Sparse genes x pathways membership matrix from the annotated results table.
+
+    Handles both one row per (gene, pathway) and sep-joined pathways per gene
+    (process_gmt.py --aggregate).
+
+    :param genes: Index giving the row order of the matrix, genes not in it are ignored
+    """
+    pairs = fdf[[gene_name, pathway_col]].dropna().astype(str).drop_duplicates()
+    if pairs[pathway_col].str.contains(sep, regex=False).any():
+        pairs = (pairs.assign(**{pathway_col: pairs[pathway_col].str.split(sep)})
+                 .explode(pathway_col).drop_duplicates())
+    rows = genes.get_indexer(pairs[gene_name])
+    pathways, cols = np.unique(pairs[pathway_col].to_numpy(), return_inverse=True)
+    keep = rows >= 0
+    matrix = sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(len(genes), len(pathways)))
+    return Membership(pd.Index(pathways), matrix)
+
+
+def bh_adjust(pvalues, axis=0):
+    """Benjamini-Hochberg adjusted p-values along axis, NaNs are left out of the correction."""
+    p = np.moveaxis(np.asarray(pvalues, dtype='float64'), axis, 0)
+    n = np.sum(np.isfinite(p), axis=0)
+    order = np.argsort(np.where(np.isfinite(p), p, np.inf), axis=0)
+    ranked = np.take_along_axis(p, order, axis=0)
+    ranks = np.arange(1, p.shape[0] + 1).reshape((-1,) + (1,) * (p.ndim - 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        adjusted = ranked * n / ranks
+    # Running minimum from the largest p-value down, NaNs sort last and stay NaN
+    adjusted = np.where(np.isfinite(adjusted), adjusted, np.inf)
+    adjusted = np.minimum.accumulate(adjusted[::-1], axis=0)[::-1]
+    adjusted = np.where(np.isfinite(ranked), np.minimum(adjusted, 1), np.nan)
+    out = np.empty_like(adjusted)
+    np.put_along_axis(out, order, adjusted, axis=0)
+    return np.moveaxis(out, 0, axis)
+
+
+def over_representation(member, hits, tested):
+    """
+    Hypergeometric test of every pathway in every contrast.
+
+    :param member: sparse genes x pathways membership
+    :param hits: genes x contrasts boolean array of significant genes
+    :param tested: genes x contrasts boolean array of genes with a result
+    :return: overlap, pathway size, expected overlap and p-values, each pathways x contrasts
+    """
+    overlap = np.asarray(member.T @ hits.astype('float64'))
+    size = np.asarray(member.T @ tested.astype('float64'))
+    universe = tested.sum(axis=0)
+    drawn = hits.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = size * drawn / universe
+    pvalues = stats.hypergeom.sf(overlap - 1, universe, size, drawn)
+    return overlap, size, expected, np.where(size > 0, pvalues, np.nan)
+
+
+def rank_test(member, scores):
+    """
+    Rank-sum (Mann-Whitney, normal approximation) test of pathway genes against all
+    other genes, for every pathway and contrast at once.
+
+    :param scores: genes x contrasts array, e.g. LFC, NaN for genes without a result
+    :return: z-scores (positive when pathway genes rank higher) and two-sided p-values
+    """
+    tested = np.isfinite(scores)
+    ranks = pd.DataFrame(scores).rank(axis=0).to_numpy()
+    rank_sum = np.asarray(member.T @ np.where(tested, ranks, 0.0))
+    k = np.asarray(member.T @ tested.astype('float64'))
+    n = tested.sum(axis=0)
+    u = rank_sum - k * (k + 1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (u - k * (n - k) / 2) / np.sqrt(k * (n - k) * (n + 1) / 12)
+    z = np.where((k > 0) & (k < n), z, np.nan)
+    return z, 2 * stats.norm.sf(np.abs(z))
+
+
+def enrichment(matrix, member, lfc_th=1.0, fdr=0.05, min_size=5):
+    """
+    Over-representation and rank-based enrichment of every pathway in every contrast.
+
+    :param matrix: contrasts.ContrastMatrix of the results
+    :param member: Membership built on matrix.genes
+    :return: long DataFrame, one row per pathway and contrast
+    """
+    tested = np.isfinite(matrix.lfc) & np.isfinite(matrix.padj)
+    with np.errstate(invalid='ignore'):
+        hits = tested & (np.abs(matrix.lfc) > lfc_th) & (matrix.padj < fdr)
+    overlap, size, expected, p_ora = over_representation(member.matrix, hits, tested)
+    z_rank, p_rank = rank_test(member.matrix, np.where(tested, matrix.lfc, np.nan))
+    small = size < min_size
+    p_ora = np.where(small, np.nan, p_ora)
+    p_rank = np.where(small, np.nan, p_rank)
+    shape = size.shape
+    return pd.DataFrame({'pathway': np.repeat(member.pathways.to_numpy(), shape[1]),
+                         'contrast': np.tile(matrix.contrasts, shape[0]),
+                         'size': size.ravel().astype(int),
+                         'hits': overlap.ravel().astype(int),
+                         'expected': expected.ravel(),
+                         'p_ora': p_ora.ravel(),
+                         'fdr_ora': bh_adjust(p_ora).ravel(),
+                         'z_rank': z_rank.ravel(),
+                         'p_rank': p_rank.ravel(),
+                         'fdr_rank': bh_adjust(p_rank).ravel()}).dropna(subset=['p_ora', 'p_rank'], how='all')
@@ -0,0 +1,138 @@
+"""
+Table downloads for the pages.
+
+Exports are written to disk in chunks of rows and cached by a key that the page
+builds from the dataset key and the filter values, so a rerun with the same filters
+reuses the file without hashing or re-rendering the table.
+"""
+
+import hashlib
+import importlib.util
+import os
+import zipfile
+
+import bundle
+
+EXPORT_DIR = bundle.CACHE_DIR / '.exports'
+EXPORT_MAX_FILES = int(os.environ.get('MIBIO_EXPORT_MAX_FILES', 64))
+CHUNK_ROWS = 50_000
+EXCEL_MAX_ROWS = 1_048_575
+
+# Label: (extension, mime type, module needed to write it)
+FORMATS = {'CSV': ('csv', 'text/csv', None),
+           'TSV': ('tsv', 'text/tab-separated-values', None),
+           'Parquet': ('parquet', 'application/octet-stream', 'pyarrow'),
+           'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'openpyxl')}
+
+
+def available_formats():
+    """Labels of the formats that can be written here."""
+    return [label for label, (_, _, module) in FORMATS.items()
+            if module is None or importlib.util.find_spec(module) is not None]
+
+
+def fingerprint(*parts):
+    """Short digest of the repr of parts, used to name cached exports."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:24]
+
+
+def iter_chunks(df, chunk_rows=CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _write_text(df, fh, sep, chunk_rows):
+    if df.empty:
+        fh.write(df.to_csv(sep=sep, index=False).encode('utf-8'))
+    for i, chunk in enumerate(iter_chunks(df, chunk_rows)):
+        fh.write(chunk.to_csv(sep=sep, index=False, header=i == 0).encode('utf-8'))
+
+
+def _write_parquet(df, fh, chunk_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(fh, schema) as writer:
+        for chunk in iter_chunks(df, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def _write_excel(df, fh, chunk_rows):
+    from openpyxl import Workbook
+    if len(df) > EXCEL_MAX_ROWS:
+        raise ValueError(f'{len(df)} rows do not fit in an Excel sheet, use CSV or Parquet')
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([str(c) for c in df.columns])
+    for chunk in iter_chunks(df, chunk_rows):
+        # Write-only sheets stream rows to disk, NaN is not valid in xlsx so it becomes an empty cell
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False, name=None):
+            ws.append(row)
+    wb.save(fh)
+
+
+def write_table(df, fh, fmt='CSV', chunk_rows=CHUNK_ROWS):
+    """
+    Write df to the binary file object fh, chunk_rows rows at a time.
+
+    :param fmt: one of FORMATS
+    """
+    ext = FORMATS[fmt][0]
+    if ext in ('csv', 'tsv'):
+        _write_text(df, fh, ',' if ext == 'csv' else '\t', chunk_rows)
+    elif ext == 'parquet':
+        _write_parquet(df, fh, chunk_rows)
+    else:
+        _write_excel(df, fh, chunk_rows)
+
+
+def prune(max_files=EXPORT_MAX_FILES):
+    """Remove the least recently used exports beyond max_files."""
+    # Dotted names are exports still being written
+    files = [f for f in EXPORT_DIR.glob('*.*') if not f.name.startswith('.')]
+    for f in sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)[max_files:]:
+        f.unlink(missing_ok=True)
+
+
+def _cached_file(name, write):
+    path = EXPORT_DIR / name
+    if path.exists():
+        path.touch()
+        return path
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    with open(tmp, 'wb') as fh:
+        write(fh)
+    os.replace(tmp, path)
+    prune()
+    return path
+
+
+def export_table(key, build, fmt='CSV', chunk_rows=CHUNK_ROWS):
+    """
+    Path of the export of a table, written on the first request for key.
+
+    :param key: hashable description of the table, e.g. (data.key('results'), filters)
+    :param build: function returning the DataFrame, only called on a cache miss
+    """
+    ext = FORMATS[fmt][0]
+    return _cached_file(f'{fingerprint(key, fmt)}.{ext}',
+                        lambda fh: write_table(build(), fh, fmt, chunk_rows))
+
+
+def export_archive(key, build, fmt='CSV', chunk_rows=CHUNK_ROWS):
+    """
+    Path of a zip archive with one table per member, written on the first request for key.
+
+    :param build: function returning an iterable of (member name, DataFrame)
+    """
+    ext = FORMATS[fmt][0]
+
+    def write(fh):
+        with zipfile.ZipFile(fh, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, df in build():
+                with zf.open(f'{name}.{ext}', 'w', force_zip64=True) as member:
+                    write_table(df, member, fmt, chunk_rows)
+
+    return _cached_file(f'{fingerprint(key, fmt, "zip")}.zip', write)
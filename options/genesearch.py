@@ -0,0 +1,119 @@
+import re
+from collections import defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+Match = namedtuple('Match', ['label', 'term', 'source', 'rows'])
+
+
+def trigrams(term):
+    """Distinct character trigrams of a lowercase term, padded so prefixes score higher."""
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class GeneSearchIndex:
+    """
+    Search gene names of several annotation columns, and their synonyms, for the rows they refer to.
+
+    Terms are kept sorted for prefix lookups by binary search, and in a trigram index for
+    substring and misspelled queries, so a search touches the matching terms only.
+    """
+
+    def __init__(self, terms, sources, rows, max_posting=5000) -> None:
+        """
+        :param terms: one entry per (term, source), original case
+        :param sources: column (or 'synonym') each term comes from
+        :param rows: array of row positions per term
+        :param max_posting: trigrams shared by more terms than this only rank candidates found
+            through rarer trigrams, so common ones do not make a search scan every term
+        """
+        keys = np.array([t.lower() for t in terms], dtype=str)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.terms = np.asarray(terms, dtype=object)[order]
+        self.sources = np.asarray(sources, dtype=object)[order]
+        self.rows = [rows[i] for i in order]
+        self.labels = [f'{t} [{s}]' for t, s in zip(self.terms, self.sources)]
+        self._by_label = {label: i for i, label in enumerate(self.labels)}
+        self.max_posting = max_posting
+        postings = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                postings[gram].append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, label):
+        """Match of a label returned by search."""
+        i = self._by_label[label]
+        return Match(label, self.terms[i], self.sources[i], self.rows[i])
+
+    def _prefix(self, query, k):
+        # The exact match, if any, sorts first among the terms starting with query
+        start = np.searchsorted(self.keys, query, side='left')
+        stop = np.searchsorted(self.keys, query + '\U0010ffff', side='left')
+        return np.arange(start, min(stop, start + k))
+
+    def _fuzzy(self, query, k, max_candidates=2000):
+        grams = trigrams(query)
+        postings = sorted((self.postings[g] for g in grams if g in self.postings), key=len)
+        if not postings:
+            return []
+        rare = [p for p in postings if len(p) <= self.max_posting] or postings[:1]
+        ids, shared = np.unique(np.concatenate(rare), return_counts=True)
+        if len(ids) > max_candidates:
+            ids = ids[np.argsort(-shared, kind='stable')[:max_candidates]]
+        # Jaccard similarity of the trigram sets, ties broken by shorter terms
+        scored = []
+        for i in ids:
+            key_grams = trigrams(self.keys[i])
+            common = len(grams & key_grams)
+            scored.append((-common / (len(grams) + len(key_grams) - common), len(self.keys[i]), i))
+        scored.sort()
+        return [i for score, _, i in scored[:k] if -score >= 0.2]
+
+    def search(self, query, k=20):
+        """
+        Labels of the top k matches of query: exact, then prefix, then trigram similarity.
+        An empty query returns the first k terms.
+        """
+        query = re.sub(r'\s+', ' ', str(query)).strip().lower()
+        ids = list(self._prefix(query, k))
+        if len(ids) < k and len(query) >= 2:
+            seen = set(ids)
+            ids += [i for i in self._fuzzy(query, 2 * k) if i not in seen][:k - len(ids)]
+        return [self.labels[i] for i in ids]
+
+
+def read_synonyms(synonym_file):
+    """Synonym table with a gene column (a name in any annotation column) and a synonym column."""
+    return pd.read_table(synonym_file, usecols=['gene', 'synonym'], dtype=str).dropna().drop_duplicates()
+
+
+def build_index(countData, annotation_cols, synonym_file=None):
+    """
+    GeneSearchIndex of the names in annotation_cols of countData and of their synonyms.
+
+    :param synonym_file: TSV read by read_synonyms, optional
+    """
+    terms, sources, rows = [], [], []
+    positions = {}
+    for col in annotation_cols:
+        groups = countData.groupby(col, sort=False).indices
+        for name, pos in groups.items():
+            terms.append(str(name))
+            sources.append(col)
+            rows.append(pos)
+            positions.setdefault(str(name), []).append(pos)
+    if synonym_file is not None:
+        for synonym, genes in read_synonyms(synonym_file).groupby('synonym', sort=False)['gene']:
+            pos = [p for g in genes for p in positions.get(g, [])]
+            if pos:
+                terms.append(synonym)
+                sources.append('synonym')
+                rows.append(np.unique(np.concatenate(pos)))
+    return GeneSearchIndex(terms, sources, rows)
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.colors import qualitative
+from plotly.subplots import make_subplots
+from scipy.cluster import hierarchy
+
+# Scatters with more points than this are drawn with dense_scatter
+WEBGL_MIN_POINTS = int(os.environ.get('MIBIO_WEBGL_MIN_POINTS', 20000))
+
+
+def density_layer(x, y, bins=150, colorscale='Blues', name='not hit'):
+    """
+    Bin points into a 2D histogram on the server, so only bins x bins counts reach the browser.
+    Empty bins are left transparent, counts are shown on a log scale.
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, xedges, yedges = np.histogram2d(x[finite], y[finite], bins=bins)
+    with np.errstate(divide='ignore'):
+        z = np.where(counts > 0, np.log10(counts), np.nan)
+    return go.Heatmap(x=(xedges[:-1] + xedges[1:]) / 2, y=(yedges[:-1] + yedges[1:]) / 2, z=z.T,
+                      customdata=counts.T, colorscale=colorscale, showscale=False, name=name,
+                      hovertemplate='%{customdata:.0f} genes<extra></extra>', hoverongaps=False)
+
+
+def dense_scatter(df, x, y, hit, hover_name, hover_data=(), colors=('#636EFA', '#EF553B'), bins=150,
+                  marker_size=6):
+    """
+    WebGL scatter for large tables: rows where hit is True stay individually hoverable,
+    the rest are collapsed into a binned density layer.
+
+    :param hit: name of a boolean column of df
+    :param hover_name: column shown in bold on hover
+    :param hover_data: extra columns shown on hover
+    :param colors: (not hit, hit) colours
+    """
+    hits = df[df[hit].to_numpy(dtype=bool)]
+    rest = df[~df[hit].to_numpy(dtype=bool)]
+    hover_data = list(hover_data)
+    template = f'<b>%{{hovertext}}</b><br>{x}=%{{x}}<br>{y}=%{{y}}'
+    template += ''.join(f'<br>{col}=%{{customdata[{i}]}}' for i, col in enumerate(hover_data))
+    fig = go.Figure()
+    colorscale = [[0, 'rgba(255,255,255,0)'], [0.01, 'rgba(200,200,230,0.6)'], [1, colors[0]]]
+    fig.add_trace(density_layer(rest[x], rest[y], bins=bins, colorscale=colorscale, name='False'))
+    fig.add_trace(go.Scattergl(x=hits[x], y=hits[y], mode='markers', name='True',
+                               hovertext=hits[hover_name].astype(str),
+                               customdata=hits[hover_data].to_numpy() if hover_data else None,
+                               hovertemplate=template + '<extra></extra>',
+                               marker=dict(size=marker_size, color=colors[1])))
+    fig.update_layout(legend_title_text=hit, xaxis_title=x, yaxis_title=y)
+    return fig
+
+
+def _dendrogram_lines(icoord, dcoord):
+    """All links of a scipy dendrogram as one polyline, leaves at 0..n-1."""
+    xs, ys = [], []
+    for xi, yi in zip(icoord, dcoord):
+        xs += [(v - 5) / 10 for v in xi] + [None]
+        ys += list(yi) + [None]
+    return xs, ys
+
+
+def clustered_heatmap(dist, labels, links, annotation=None, colorscale='Viridis', max_tick_labels=60,
+                      value_name='distance'):
+    """
+    Square heatmap of dist ordered by a hierarchical clustering, with its dendrogram on the
+    top and left. Each dendrogram is a single trace, whatever the number of samples.
+
+    :param dist: samples x samples array, in the order of labels
+    :param links: scipy linkage matrix of dist
+    :param annotation: optional Series indexed by label, drawn as a coloured strip under the top dendrogram
+    """
+    tree = hierarchy.dendrogram(links, no_plot=True)
+    leaves = tree['leaves']
+    n = len(leaves)
+    names = [str(labels[i]) for i in leaves]
+    fig = make_subplots(rows=3, cols=2, column_widths=[0.12, 0.88], row_heights=[0.12, 0.03, 0.85],
+                        horizontal_spacing=0.005, vertical_spacing=0.005)
+    xs, ys = _dendrogram_lines(tree['icoord'], tree['dcoord'])
+    line = dict(color='DarkSlateGrey', width=1)
+    fig.add_trace(go.Scatter(x=xs, y=ys, mode='lines', line=line, hoverinfo='skip', showlegend=False), row=1, col=2)
+    fig.add_trace(go.Scatter(x=ys, y=xs, mode='lines', line=line, hoverinfo='skip', showlegend=False), row=3, col=1)
+    ordered = np.asarray(dist)[np.ix_(leaves, leaves)]
+    fig.add_trace(go.Heatmap(z=np.round(ordered, 4), x=names, y=names, colorscale=colorscale,
+                             colorbar=dict(title=value_name, len=0.8, y=0.4),
+                             hovertemplate=f'%{{y}} / %{{x}}<br>{value_name}=%{{z}}<extra></extra>'),
+                  row=3, col=2)
+    if annotation is not None:
+        values = annotation.reindex(names).astype(str).to_numpy()
+        colors = qualitative.Plotly
+        for i, level in enumerate(pd.unique(values)):
+            pos = np.flatnonzero(values == level)
+            fig.add_trace(go.Bar(x=pos, y=np.ones(len(pos)), width=1, name=level,
+                                 marker=dict(color=colors[i % len(colors)], line=dict(width=0)),
+                                 hovertext=[names[p] for p in pos],
+                                 hovertemplate=f'%{{hovertext}}: {level}<extra></extra>'),
+                          row=2, col=2)
+        fig.update_layout(legend_title_text=annotation.name, bargap=0)
+    # Leaves sit at 0..n-1 on every axis along the samples, rows run top to bottom
+    span, reverse = [-0.5, n - 0.5], [n - 0.5, -0.5]
+    hidden = dict(showticklabels=False, showgrid=False, zeroline=False)
+    fig.update_xaxes(range=span, **hidden, row=1, col=2)
+    fig.update_xaxes(range=span, **hidden, row=2, col=2)
+    fig.update_xaxes(range=span, showticklabels=n <= max_tick_labels, row=3, col=2)
+    fig.update_yaxes(range=reverse, showticklabels=n <= max_tick_labels, side='right', row=3, col=2)
+    fig.update_yaxes(range=reverse, **hidden, row=3, col=1)
+    fig.update_xaxes(autorange='reversed', **hidden, row=3, col=1)
+    fig.update_yaxes(**hidden, row=1, col=2)
+    fig.update_yaxes(visible=False, row=2, col=2)
+    for row, col in ((1, 1), (2, 1)):
+        fig.update_xaxes(visible=False, row=row, col=col)
+        fig.update_yaxes(visible=False, row=row, col=col)
+    fig.update_layout(plot_bgcolor='rgba(0,0,0,0)')
+    return fig
@@ -0,0 +1,224 @@
+"""
+STRING (string-db.org) client used by the DiffAb page.
+
+Responses are cached on disk keyed on (gene set, species, network flavor), requests
+share a pooled session, run on a background thread and are rate limited with a
+token bucket. StandInStringServer answers the same API locally, so the client can be
+tested and benchmarked without network access (point MIBIO_STRING_URL at it).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import bundle
+
+STRING_API_URL = os.environ.get('MIBIO_STRING_URL', 'https://version-11-5.string-db.org/api')
+CALLER_IDENTITY = 'mibio'
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, with bursts of up to capacity."""
+
+    def __init__(self, rate=1.0, capacity=1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ResponseCache:
+    """Persistent key -> text cache in a SQLite file, safe to share between threads and processes."""
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self._connect() as db:
+            row = db.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, value, time.time()))
+
+
+class StringClient:
+    """Cached, rate-limited, non-blocking access to the STRING get_link endpoint."""
+
+    def __init__(self, api_url=STRING_API_URL, cache_file=None, rate=1.0, timeout=30, max_workers=2) -> None:
+        self.api_url = api_url.rstrip('/')
+        self.cache = ResponseCache(cache_file or bundle.CACHE_DIR / 'string_cache.sqlite')
+        self.bucket = TokenBucket(rate)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='string')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(genes, species, flavor='confidence'):
+        """Cache key of a query, independent of gene order and duplicates."""
+        spec = json.dumps([sorted(set(map(str, genes))), int(species), flavor])
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def cached(self, genes, species, flavor='confidence'):
+        """Network link from the cache, None if this query was never fetched."""
+        return self.cache.get(self.key(genes, species, flavor))
+
+    def get_link(self, genes, species, flavor='confidence'):
+        """Link to the STRING network of genes, fetched (blocking) only on a cache miss."""
+        key = self.key(genes, species, flavor)
+        link = self.cache.get(key)
+        if link is not None:
+            return link
+        self.bucket.acquire()
+        params = {'identifiers': '\r'.join(sorted(set(map(str, genes)))),
+                  'species': int(species),
+                  'network_flavor': flavor,
+                  'caller_identity': CALLER_IDENTITY}
+        response = self.session.post(f'{self.api_url}/tsv-no-header/get_link', data=params, timeout=self.timeout)
+        response.raise_for_status()
+        link = response.text.strip()
+        self.cache.set(key, link)
+        return link
+
+    def submit(self, genes, species, flavor='confidence'):
+        """Fetch in the background, returns a Future. Identical in-flight queries share one Future."""
+        key = self.key(genes, species, flavor)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._executor.submit(self.get_link, genes, species, flavor)
+                self._pending[key] = future
+                future.add_done_callback(lambda f: self._forget(key, f))
+            return future
+
+    def _forget(self, key, future):
+        # Successful results live in the persistent cache, failed ones may be retried
+        with self._lock:
+            if self._pending.get(key) is future and future.exception() is None:
+                del self._pending[key]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide StringClient, so the cache, pool and rate limit are shared by all sessions."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = StringClient()
+        return _client
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = parse_qs(body)
+        self.server.requests.append((self.path, params))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.path.endswith('/get_link'):
+            self.send_error(404)
+            return
+        genes = params.get('identifiers', [''])[0].split('\r')
+        digest = hashlib.sha1('\r'.join(sorted(genes)).encode()).hexdigest()[:12]
+        payload = f'https://string-db.org/cgi/link?to=STANDIN{digest}\n'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInStringServer:
+    """
+    Local stand-in for the STRING API, answering get_link with a deterministic fake link.
+
+        with StandInStringServer(latency=0.2) as server:
+            client = StringClient(server.api_url, cache_file=...)
+    """
+
+    def __init__(self, port=0, latency=0.0) -> None:
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _StandInHandler)
+        self._server.latency = latency
+        self._server.requests = []
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api'
+
+    @property
+    def requests(self):
+        """(path, params) of every request received so far."""
+        return self._server.requests
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the STRING stand-in server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering')
+    args = parser.parse_args()
+    server = StandInStringServer(args.port, args.latency).start()
+    print(f'Serving STRING stand-in, set MIBIO_STRING_URL={server.api_url}')
+    server._thread.join()
@@ -1,31 +1,76 @@
 #import plotnine as p9
+import weakref
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 
 
+CORRELATION_MODES = ('raw', 'log', 'log_w_0')
+_controls = {}
+
+
+def load_controls(control_file):
+    """Parse a control barcode file once, re-read only when it changes on disk."""
+    path = Path(control_file)
+    key = (str(path.resolve()), path.stat().st_mtime)
+    if key not in _controls:
+        _controls[key] = pd.read_table(path, names=['barcode', 'phenotype', 'conc'])
+    return _controls[key]
+
+
+def _grouped_pearson(keys, x, y):
+    """Pearson R of x and y within each group, from grouped sums over the finite pairs."""
+    ok = np.isfinite(x) & np.isfinite(y)
+    x = np.where(ok, x, 0.0)
+    y = np.where(ok, y, 0.0)
+    sums = pd.DataFrame({'n': ok.astype('float64'), 'x': x, 'y': y, 'xx': x * x, 'yy': y * y, 'xy': x * y})
+    sums = sums.groupby(keys, sort=True).sum()
+    n = sums['n']
+    cov = sums['xy'] - sums['x'] * sums['y'] / n
+    var_x = sums['xx'] - sums['x'] ** 2 / n
+    var_y = sums['yy'] - sums['y'] ** 2 / n
+    with np.errstate(all='ignore'):
+        r = cov / np.sqrt(var_x * var_y)
+    return r.where((n > 1) & (var_x > 0) & (var_y > 0)).clip(-1, 1)
+
+
+def control_correlations(exp_df, controls, for_each='sampleID', modes=CORRELATION_MODES):
+    """
+    Pearson R between expected and observed control barcode abundance for every
+    phenotype x for_each group, for several modes in one pass.
+
+    Modes: raw counts (raw), log counts with zero counts left out (log), or log counts
+    with zeros counted as 1 (log_w_0).
+
+    :param controls: DataFrame with barcode, phenotype and conc columns (see load_controls)
+    :return: DataFrame with phenotype, sampleID, one R column per mode
+    """
+    counts = exp_df[exp_df.barcode.isin(controls.barcode)]
+    counts = counts.drop(columns=[c for c in ['phenotype', 'conc'] if c in counts.columns])
+    counts = counts.merge(controls, on='barcode')
+    keys = [counts['phenotype'].to_numpy(), counts[for_each].to_numpy()]
+    conc = counts['conc'].to_numpy(dtype='float64')
+    cnt = counts['cnt'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_conc = np.log10(conc)
+        pairs = {'raw': (conc, cnt),
+                 'log': (log_conc, np.log10(cnt)),
+                 'log_w_0': (log_conc, np.log10(np.where(cnt == 0, 1, cnt)))}
+    corr_df = pd.concat({mode: _grouped_pearson(keys, *pairs[mode]) for mode in modes}, axis=1)
+    corr_df.index.names = ['phenotype', 'sampleID']
+    return corr_df.reset_index()
+
+
 def calculate_correlation(exp_df, control_file, for_each='sampleID', how='log', cutoff=0.9):
     """
     Subset counts for control barcodes
     Calculate correlation on log counts (log), log counts, but keep 0 (log_w_0), or raw data (raw)
 
     """
-    controls = pd.read_table(control_file, names=['barcode', 'phenotype', 'conc'])
-    control_cnts = exp_df[exp_df.barcode.isin(controls.barcode)].copy()
-    if how == 'raw':
-        col1 = 'conc'
-        col2 = 'cnt'
-    else:
-        control_cnts['logConc'] = np.log10(control_cnts['conc'])
-        col1 = 'logConc'
-        if how == 'log':
-            control_cnts['logCnts'] = np.log10(control_cnts['cnt'])
-        elif how == 'log_w_0':
-            control_cnts['logCnts'] = np.log10(control_cnts['cnt'].replace({0: 1}))
-        col2 = 'logCnts'
-    corr_df = control_cnts.groupby(['phenotype', for_each])[[col1, col2]].corr()
-    corr_df = corr_df.reset_index()
-    corr_df = corr_df[corr_df['level_2'] == col1].drop(['level_2', col1], axis=1)
-    corr_df.columns = ['phenotype', 'sampleID', 'R']
+    controls = load_controls(control_file)
+    corr_df = control_correlations(exp_df, controls, for_each, modes=[how])
+    corr_df = corr_df.rename({how: 'R'}, axis=1)
 
     good_samples = corr_df[(corr_df.R > cutoff) & (corr_df.phenotype == 'wt')].sampleID.values
     return corr_df, good_samples
@@ -92,22 +137,54 @@ def filter_inoculum(exp_df, filter_below=0):
 #    return exp_df.copy()[exp_df.sampleID.isin(good_samples)]
 
 
+def inoculum_mask(df, to_filter=1000):
+    """
+    Boolean mask of the rows of df whose barcode reaches to_filter counts in every
+    inoculum sample of its (dnaid, experiment). Computed for all experiments in one pass.
+    Experiments without inoculum samples keep all their barcodes.
+    """
+    keys = ['dnaid', 'experiment']
+    inoc = df.loc[df.sampleID.astype(str).str.contains('inoculum', regex=False).to_numpy(dtype=bool),
+                  keys + ['sampleID', 'barcode', 'cnt']]
+    inoc = inoc.drop_duplicates(keys + ['sampleID', 'barcode'])
+    n_inoc = inoc.groupby(keys).sampleID.nunique().rename('n_inoc')
+    n_passed = (inoc[inoc.cnt >= to_filter].groupby(keys + ['barcode']).sampleID.nunique()
+                .rename('n_passed').reset_index())
+    passed = n_passed.merge(n_inoc.reset_index(), on=keys)
+    passed = passed[passed.n_passed == passed.n_inoc]
+    row_keys = pd.MultiIndex.from_frame(df[keys + ['barcode']])
+    mask = row_keys.isin(pd.MultiIndex.from_frame(passed[keys + ['barcode']]))
+    no_inoculum = ~pd.MultiIndex.from_frame(df[keys]).isin(n_inoc.index)
+    return mask | no_inoculum
+
+
 def filter_all_exps(df, to_filter=1000):
-    filt_dfs = []
-    for i,g in df.groupby(['dnaid', 'experiment']):
-        fildf = filter_inoculum(g, to_filter).reset_index().rename({'index':'barcode'}, axis=1)
-        fildf = fildf.melt(id_vars=['barcode'], value_name='cnt').assign(dnaid=i[0], experiment=i[1])
-        filt_dfs.append(fildf)
-    fdf = pd.concat(filt_dfs)
-    tdf = fdf.merge(df[['barcode', 'ShortName', 'locus_tag', 'dnaid','experiment', 'sampleID', 'mouse', 'day', 'organ']],
-                  on=['dnaid', 'experiment', 'sampleID', 'barcode'], how='left')
-    return tdf
+    """Rows of df whose barcodes pass the inoculum filter of their experiment."""
+    cols = ['barcode', 'sampleID', 'cnt', 'dnaid', 'experiment', 'ShortName', 'locus_tag', 'mouse', 'day', 'organ']
+    return df.loc[inoculum_mask(df, to_filter), cols].drop_duplicates().reset_index(drop=True)
 
 
-def view_barcodes(df, gene, to_filter=0):
+_filtered = {}
+
+
+def filtered_by_gene(df, to_filter=0):
+    """
+    filter_all_exps(df, to_filter) indexed by ShortName, cached for as long as df is alive,
+    so looking up one gene after another does not refilter the whole table.
+    """
+    key = (id(df), to_filter)
+    if key in _filtered and _filtered[key][0]() is df:
+        return _filtered[key][1]
     count_df = filter_all_exps(df, to_filter)
+    count_df = count_df.set_index('ShortName', drop=False).sort_index()
+    _filtered[key] = (weakref.ref(df, lambda ref: _filtered.pop(key, None)), count_df)
+    return count_df
+
+
+def view_barcodes(df, gene, to_filter=0):
+    count_df = filtered_by_gene(df, to_filter)
 
-    gene_df = count_df[count_df.ShortName == gene]
+    gene_df = count_df.loc[[gene]] if gene in count_df.index else count_df.iloc[:0]
     nbc = gene_df.barcode.nunique()
     if nbc == 0:
         return f"{gene} not found"
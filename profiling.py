@@ -0,0 +1,207 @@
+"""
+Per-rerun profiling of the pages.
+
+Every rerun of the app collects a Profile in the thread running the script:
+
+- stages timed with profiling.stage() / @profiling.timed(), by kind (load, compute,
+  figure, serialize). Dataset loads and derived results are timed by datasets.py,
+  figure building by the pages and serialization of charts and tables by install().
+- the size of every element sent to the browser.
+
+MultiPage.run finishes the profile after the page. It is appended as one JSON line
+to MIBIO_PROFILE_LOG when that is set, and shown in a sidebar panel when
+MIBIO_PROFILE_PANEL is set or the page URL has ?profile=1.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('load', 'compute', 'figure', 'serialize')
+PROFILE_LOG = os.environ.get('MIBIO_PROFILE_LOG')
+PROFILE_PANEL = os.environ.get('MIBIO_PROFILE_PANEL', '') not in ('', '0')
+# Streamlit methods whose time is counted as serialization of their argument
+SERIALIZED_ELEMENTS = ('plotly_chart', 'dataframe', 'table', 'altair_chart', 'pyplot', 'download_button')
+HISTORY = 20
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+
+class Profile:
+    """Stages and payload sizes of one rerun."""
+
+    def __init__(self, label='') -> None:
+        self.label = label
+        self.meta = {}
+        self.stages = []
+        self.payload = {}
+        self.started = time.perf_counter()
+        self.timestamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self.total = None
+        self._depth = 0
+
+    def add_payload(self, element, nbytes):
+        count, total = self.payload.get(element, (0, 0))
+        self.payload[element] = (count + 1, total + nbytes)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        return self
+
+    def by_kind(self):
+        """Seconds spent in each kind of stage, counting nested stages once, and in nothing timed."""
+        seconds = dict.fromkeys(KINDS, 0.0)
+        for s in self.stages:
+            if s['depth'] == 0:
+                seconds[s['kind']] = seconds.get(s['kind'], 0.0) + s['seconds']
+        if self.total is not None:
+            seconds['other'] = max(self.total - sum(seconds.values()), 0.0)
+        return seconds
+
+    def to_dict(self):
+        return {'time': self.timestamp,
+                'label': self.label,
+                **self.meta,
+                'total_s': self.total,
+                'by_kind_s': self.by_kind(),
+                'payload_bytes': sum(total for _, total in self.payload.values()),
+                'payload': {k: {'elements': c, 'bytes': b} for k, (c, b) in self.payload.items()},
+                'stages': self.stages}
+
+
+def begin(label=''):
+    """Start the profile of this rerun, replacing any left over by an earlier one."""
+    _local.profile = Profile(label)
+    return _local.profile
+
+
+def current():
+    """Profile of the rerun running in this thread, None outside of one."""
+    return getattr(_local, 'profile', None)
+
+
+def finish():
+    """Close the profile of this rerun, log it and return it."""
+    profile = current()
+    _local.profile = None
+    if profile is None:
+        return None
+    profile.finish()
+    if PROFILE_LOG:
+        write_jsonl(PROFILE_LOG, [profile])
+    return profile
+
+
+@contextmanager
+def stage(name, kind='compute'):
+    """Time the enclosed block as a stage of the current profile, a no-op outside of one."""
+    profile = current()
+    if profile is None:
+        yield
+        return
+    record = {'kind': kind, 'name': str(name), 'depth': profile._depth, 'seconds': None}
+    profile.stages.append(record)
+    profile._depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        profile._depth -= 1
+
+
+def timed(kind='compute', name=None):
+    """Decorator timing every call of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_jsonl(path, profiles):
+    """Append profiles to path, one JSON object per line."""
+    with open(path, 'a') as fh:
+        for profile in profiles:
+            fh.write(json.dumps(profile.to_dict(), default=str) + '\n')
+
+
+def to_jsonl(profiles):
+    return ''.join(json.dumps(p.to_dict(), default=str) + '\n' for p in profiles)
+
+
+def install():
+    """
+    Hook Streamlit once per process: element sizes are recorded as they are sent,
+    and the methods in SERIALIZED_ELEMENTS are timed as serialize stages.
+    """
+    global _installed
+    # Streamlit is only imported here, so datasets.py and the scripts stay usable without it
+    import streamlit as st
+    from streamlit.delta_generator import DeltaGenerator
+    with _install_lock:
+        if _installed:
+            return
+        _installed = True
+        enqueue = DeltaGenerator._enqueue
+
+        @functools.wraps(enqueue)
+        def _enqueue(self, delta_type, element_proto, *args, **kwargs):
+            profile = current()
+            if profile is not None:
+                profile.add_payload(delta_type, element_proto.ByteSize())
+            return enqueue(self, delta_type, element_proto, *args, **kwargs)
+
+        DeltaGenerator._enqueue = _enqueue
+        main = getattr(st, '_main', None)
+        for name in SERIALIZED_ELEMENTS:
+            method = getattr(DeltaGenerator, name, None)
+            if method is None:
+                continue
+            setattr(DeltaGenerator, name, timed('serialize', name)(method))
+            # st.<name> is bound to the main container when streamlit is imported
+            if main is not None and getattr(getattr(st, name, None), '__self__', None) is main:
+                setattr(st, name, getattr(main, name))
+
+
+def panel_enabled():
+    import streamlit as st
+    if PROFILE_PANEL:
+        return True
+    return st.experimental_get_query_params().get('profile', ['0'])[0] not in ('', '0')
+
+
+def render_panel(profile):
+    """Sidebar summary of profile and the earlier profiles of this session, with a JSON lines download."""
+    import pandas as pd
+    import streamlit as st
+
+    import datasets
+    from multipage import IMPORT_METRICS
+    history = st.session_state.setdefault('profiles', [])
+    history.append(profile)
+    del history[:-HISTORY]
+    with st.sidebar.expander('Profiling', expanded=True):
+        st.write(f'**{profile.label}**: {profile.total:.3f}s, '
+                 f'{profile.to_dict()["payload_bytes"] / 1e6:.2f} MB sent')
+        st.dataframe(pd.Series(profile.by_kind(), name='seconds').round(3))
+        st.dataframe(pd.DataFrame(profile.stages, columns=['kind', 'name', 'depth', 'seconds']).round(3))
+        st.dataframe(pd.DataFrame([(k, c, b) for k, (c, b) in profile.payload.items()],
+                                  columns=['element', 'count', 'bytes']).sort_values('bytes', ascending=False))
+        resident = datasets.resident()
+        st.write(f'Resident datasets: {resident["bytes"].sum() / 1e6:.1f} MB')
+        if IMPORT_METRICS:
+            st.dataframe(pd.Series(IMPORT_METRICS, name='import seconds').round(3))
+        st.download_button('Download profiles (JSON lines)', to_jsonl(history),
+                           file_name='profiles.jsonl', mime='application/x-ndjson')
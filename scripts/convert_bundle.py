@@ -0,0 +1,111 @@
+"""
+Convert the CSV tables of a results directory to a columnar format.
+
+Writes a .parquet (or .feather) file next to every large input table, with
+contrast, KEGG_Pathway and annotation columns stored as categoricals, and a
+columnar.yaml manifest listing what was converted. The app prefers these files
+when they are listed in the manifest and falls back to the CSVs otherwise.
+
+usage: python scripts/convert_bundle.py RESULTS_DIR [--format feather] [--memmap] [--archive bundle.tar.gz]
+"""
+
+import argparse
+import sys
+import tarfile
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import matrixstore
+
+MANIFEST = 'columnar.yaml'
+CATEGORICAL = ['contrast', 'KEGG_Pathway']
+RESULTS = '*unfiltered*results*kegg.csv'
+# count matrices, can be converted to the memmap format instead
+MATRICES = ['*vsd.csv', '*tpms*.csv']
+# pattern -> column used as the index, None if the table has no index
+TABLES = {RESULTS: None,
+          '*vsd.csv': 0,
+          '*tpms*.csv': None}
+
+
+def convert_table(csv_file, fmt='parquet', index_col=None, categorical=()):
+    """Convert one CSV, returns its manifest entry."""
+    csv_file = Path(csv_file)
+    df = pd.read_csv(csv_file, index_col=index_col)
+    for col in df.columns:
+        if col in categorical:
+            df[col] = df[col].astype('category')
+    out_file = csv_file.with_suffix(f'.{fmt}')
+    if index_col is not None and df.index.name is None:
+        # A blank first header cell (R's write.csv), named so the manifest can point at the column
+        df.index.name = 'index'
+    index = df.index.name if index_col is not None else None
+    if fmt == 'parquet':
+        df.to_parquet(out_file, index=index_col is not None)
+    elif fmt == 'feather':
+        # Feather does not store an index, it is written as the first column
+        (df.reset_index() if index_col is not None else df).to_feather(out_file)
+    else:
+        raise ValueError(f'Unknown format {fmt}')
+    return {'file': out_file.name,
+            'format': fmt,
+            'index': index,
+            'rows': int(df.shape[0]),
+            'columns': [str(c) for c in df.columns],
+            'categorical': [str(c) for c in df.columns if df[c].dtype.name == 'category']}
+
+
+def convert_bundle(datadir, fmt='parquet', memmap=False):
+    """
+    Convert every large table in datadir and write the manifest.
+
+    :param memmap: store the count matrices as memory-mapped float32 (see matrixstore)
+    """
+    datadir = Path(datadir)
+    with open(datadir / 'pages.yaml') as fh:
+        config = yaml.safe_load(fh)
+    categorical = set(CATEGORICAL) | set(config.get('annotation', []))
+    files = {}
+    for pattern, index_col in TABLES.items():
+        for csv_file in sorted(datadir.glob(pattern)):
+            # Annotation values repeat once per contrast only in the long results table
+            cats = categorical if pattern == RESULTS else CATEGORICAL
+            if memmap and pattern in MATRICES:
+                labels = config.get('annotation', []) if index_col is None else None
+                files[csv_file.name] = matrixstore.write_matrix(csv_file, labels, index_col)
+            else:
+                files[csv_file.name] = convert_table(csv_file, fmt, index_col, cats)
+            print(f'{csv_file.name} -> {files[csv_file.name]["file"]}')
+    with open(datadir / MANIFEST, 'w') as fh:
+        yaml.safe_dump({'format': fmt, 'files': files}, fh, sort_keys=False)
+    return files
+
+
+def package(datadir, archive, drop_csv=True):
+    """Write datadir as an uploadable .tar.gz, leaving out the converted CSVs."""
+    datadir = Path(datadir)
+    with open(datadir / MANIFEST) as fh:
+        converted = set(yaml.safe_load(fh)['files'])
+    # Sidecars of the converted files are written next to them and packaged as they are
+    with tarfile.open(archive, 'w:gz') as tar:
+        for f in sorted(datadir.iterdir()):
+            if drop_csv and f.name in converted:
+                continue
+            tar.add(f, arcname=f'{datadir.name}/{f.name}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('datadir', help='Results directory containing pages.yaml')
+    parser.add_argument('--format', default='parquet', choices=['parquet', 'feather'])
+    parser.add_argument('--memmap', action='store_true',
+                        help='Store the vsd and TPM matrices as memory-mapped float32 with label sidecars')
+    parser.add_argument('--archive', help='Also package the directory as this .tar.gz')
+    parser.add_argument('--keep-csv', action='store_true', help='Keep converted CSVs in the archive')
+    args = parser.parse_args()
+    convert_bundle(args.datadir, args.format, args.memmap)
+    if args.archive:
+        package(args.datadir, args.archive, drop_csv=not args.keep_csv)
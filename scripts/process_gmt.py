@@ -1,29 +1,118 @@
-import pandas as pd
+"""
+Annotate results tables with pathways from a GMT file.
+
+usage: python scripts/process_gmt.py GMT_FILE RESULTS.csv [RESULTS.csv ...] --left-on SYMBOL [--path-name 2] [--aggregate]
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+
+def iter_gmt(gmt_file, path_name=1):
+    """Stream a GMT file, yielding (pathway, [genes]) one line at a time."""
+    with open(gmt_file, 'r', errors='ignore') as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            genes = [g for g in fields[path_name:] if g]
+            if genes:
+                yield ":".join(fields[0:path_name]), genes
+
+
 def proces_gmt(gmt_file, path_name=1):
+    """
+    Gene -> pathway table of a GMT file, one row per (gene, pathway) pair.
+    Both columns are categoricals, so repeated names are stored once.
+    """
+    path_codes = {}
+    codes = []
     genes = []
-    paths = []
-    with open(gmt_file, 'r', errors='ignore') as fh:
-        for line in fh.readlines():
-            for gene in line.split('\t')[path_name:]:
-                genes.append(gene.strip("\n"))
-                paths.append(":".join(line.split('\t')[0:path_name]))
-    return pd.DataFrame([genes, paths], index=['Name', 'KEGG_Pathway']).T
+    for path, path_genes in iter_gmt(gmt_file, path_name):
+        # The same pathway name may appear on several lines
+        code = path_codes.setdefault(path, len(path_codes))
+        codes.append(np.full(len(path_genes), code, dtype='int32'))
+        genes.extend(path_genes)
+    codes = np.concatenate(codes) if codes else np.array([], dtype='int32')
+    return pd.DataFrame({'Name': pd.Categorical(genes),
+                         'KEGG_Pathway': pd.Categorical.from_codes(codes, categories=list(path_codes))})
 
 
-def merge_with_results(results_files, gmt_df, left_on):
-    for results_file in results_files:
-        resDf = pd.read_csv(results_file).rename({left_on: 'Name'}, axis=1)
-        resDf = resDf.merge(gmt_df, how='left', on='Name')
-        resDf.to_csv(Path(results_file).with_suffix('.kegg.csv'), index=False)
+def aggregate_pathways(gmt_df, sep=';'):
+    """One row per gene with all of its pathways joined by sep."""
+    df = gmt_df.astype({'Name': str, 'KEGG_Pathway': str}).drop_duplicates()
+    return df.groupby('Name', sort=True)['KEGG_Pathway'].agg(sep.join).reset_index()
 
 
+class PathwayIndex:
+    """Hash index of a gene -> pathway table, built once and joined against many results tables."""
 
-if __name__ == "__main__":
-    gmt_file = "/data/ath_rnaseq/old/ath.gmt"
-    res_files = ["/Users/ansintsova/git_repos/tnseq_app/data/ath_rnaseq/log2tpm_expression.csv",
-                "/Users/ansintsova/git_repos/tnseq_app/data/ath_rnaseq/diffab.csv"]
-    gmt_df = proces_gmt(gmt_file, path_name=2)
+    def __init__(self, gmt_df, aggregate=False, sep=';') -> None:
+        if aggregate:
+            gmt_df = aggregate_pathways(gmt_df, sep)
+        df = gmt_df.astype({'Name': str}).sort_values('Name', kind='stable')
+        names = df['Name'].to_numpy()
+        self.genes, self.starts, self.counts = np.unique(names, return_index=True, return_counts=True)
+        self.genes = pd.Index(self.genes)
+        self.pathways = df['KEGG_Pathway'].to_numpy(dtype=object)
+
+    def join(self, resDf, on='Name'):
+        """Left join resDf with the pathways, like resDf.merge(gmt_df, how='left', on=on)."""
+        pos = self.genes.get_indexer(resDf[on].astype(str))
+        found = pos >= 0
+        counts = np.where(found, self.counts[pos], 1)
+        rows = np.repeat(np.arange(len(resDf)), counts)
+        # Position of every output row within the pathways of its gene
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        source = np.repeat(np.where(found, self.starts[pos], -1), counts) + offsets
+        pathways = np.where(np.repeat(found, counts), self.pathways[np.where(source >= 0, source, 0)], np.nan)
+        out = resDf.iloc[rows].reset_index(drop=True)
+        out['KEGG_Pathway'] = pathways
+        return out
 
-    merge_with_results(res_files, gmt_df, left_on='SYMBOL')
+
+_index = None
+
+
+def _init_worker(index):
+    global _index
+    _index = index
+
+
+def _merge_one(results_file, left_on):
+    resDf = pd.read_csv(results_file).rename({left_on: 'Name'}, axis=1)
+    out_file = Path(results_file).with_suffix('.kegg.csv')
+    _index.join(resDf).to_csv(out_file, index=False)
+    return out_file
+
+
+def merge_with_results(results_files, gmt_df, left_on, aggregate=False, n_jobs=None):
+    """
+    Write a .kegg.csv next to every results file, with the pathways of each gene.
+
+    :param aggregate: one row per gene with ';'-joined pathways, instead of one row per pathway
+    :param n_jobs: worker processes, defaults to one per CPU (1 runs in this process)
+    """
+    index = PathwayIndex(gmt_df, aggregate)
+    n_jobs = n_jobs or min(len(results_files), os.cpu_count() or 1)
+    if n_jobs <= 1:
+        _init_worker(index)
+        return [_merge_one(f, left_on) for f in results_files]
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(index,)) as pool:
+        return list(pool.map(_merge_one, results_files, [left_on] * len(results_files)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('gmt_file')
+    parser.add_argument('results_files', nargs='+')
+    parser.add_argument('--left-on', default='SYMBOL', help='Gene column of the results files')
+    parser.add_argument('--path-name', type=int, default=1, help='Number of leading GMT fields naming a pathway')
+    parser.add_argument('--aggregate', action='store_true', help='One row per gene with ;-joined pathways')
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+    gmt_df = proces_gmt(args.gmt_file, path_name=args.path_name)
+    merge_with_results(args.results_files, gmt_df, left_on=args.left_on, aggregate=args.aggregate, n_jobs=args.jobs)
@@ -0,0 +1,217 @@
+"""
+Render the pages of project bundles into self-contained static HTML reports.
+
+usage: python scripts/render_report.py BUNDLE.tar.gz [BUNDLE.tar.gz ...] [--out reports] [--genes GENE ...]
+                                       [--gene-file genes.txt] [--fdr 0.05] [--lfc 1] [--jobs N]
+
+For every enabled page the report holds the PCA and sample distances (EDA), a volcano and
+an LFC ranking plot per contrast (DiffAb), a plot per requested gene (Expression) and the
+assembly stats (Assembly). Figures of all bundles are built in a pool of worker processes,
+plotly.js is embedded once per report so it opens offline.
+"""
+
+import argparse
+import html
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from plotly.offline import get_plotlyjs
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bundle
+import datasets
+from options import Assembly, DiffAb, EDA, Expression, genesearch, plotting
+
+NUM_GENES = 500
+STYLE = """<style>
+body {font-family: sans-serif; margin: 2em auto; max-width: 1400px; color: #222}
+nav a {margin-right: 1em} .figure {margin-bottom: 2em} .error {color: #b00; white-space: pre-wrap}
+</style>"""
+
+
+def _counts(data):
+    matrix = data.matrix('vsd')
+    return data.get('vsd') if matrix is None else matrix
+
+
+def _pca(data, options):
+    sample_data = data.get('sample_data')
+    pDf, pc_var = EDA.find_PCs(_counts(data), sample_data, 2, NUM_GENES, key=data.key('vsd'))
+    color = sample_data.columns[0] if len(sample_data.columns) else None
+    return EDA.pca_figure(pDf, pc_var, 'PC1', 'PC2', color, sample_data.columns)
+
+
+def _sample_distances(data, options):
+    counts = _counts(data)
+    sample_data = data.get('sample_data')
+    dist, links = EDA.cluster_samples(counts, NUM_GENES, 'pearson', key=data.key('vsd'))
+    annotation = sample_data[sample_data.columns[0]] if len(sample_data.columns) else None
+    fig = plotting.clustered_heatmap(dist, list(counts.columns), links, annotation, value_name='1 - r')
+    fig.update_layout(height=800)
+    return fig
+
+
+def _contrast_results(data, contrast):
+    config = data.config
+    lfc, pval = config['lfc_col'][0], config['pval_col'][0]
+    df = data.contrast_rows(contrast)
+    return df, lfc, pval, config['annotation'][0], config.get('webgl_min_points', plotting.WEBGL_MIN_POINTS)
+
+
+def _volcano(data, options, contrast):
+    df, lfc, pval, gene_name, webgl_min_points = _contrast_results(data, contrast)
+    fig = DiffAb.volcano_figure(df, lfc, pval, gene_name, options['fdr'], options['lfc'], webgl_min_points)
+    fig.update_layout(title=contrast)
+    return fig
+
+
+def _ranking(data, options, contrast):
+    df, lfc, pval, gene_name, webgl_min_points = _contrast_results(data, contrast)
+    return DiffAb.ranking_figure(df, lfc, pval, gene_name, options['fdr'], options['lfc'], contrast,
+                                 webgl_min_points)
+
+
+def _expression(data, options, query):
+    config = data.config
+    annotation_cols = config['annotation']
+    sample_sheet = data.get('sample_data').reset_index()
+    sampleID = config['sampleID'][0]
+    matrix = data.matrix('tpms')
+    countData = data.get('tpms') if matrix is None else matrix.labels
+    search = data.derive('gene_search', genesearch.build_index, countData, annotation_cols,
+                         next(data.datadir.glob('*synonyms.tsv'), None))
+    labels = search.search(query, 1)
+    if not labels:
+        return None
+    _, gene, gene_name, rows = search.match(labels[0])
+    samples = list(sample_sheet[sampleID])
+    if matrix is None:
+        values = Expression.log_expression(countData.iloc[rows], samples)
+    else:
+        values = np.log2(matrix.take(rows, matrix.column_positions(samples)) + 0.5)
+    tpm_label = 'log2 (TPM)'
+    gene_df = Expression.gene_expression(values, gene, gene_name, sample_sheet, sampleID, tpm_label)
+    factors = [c for c in sample_sheet.columns if c != sampleID] or [sampleID]
+    return Expression.expression_figure(gene_df, gene, gene_name, factors[0], factors[-1], tpm_label,
+                                        sample_sheet.columns)
+
+
+def _assembly(data, options, stats):
+    df = data.derive('assembly_reports', Assembly.load_reports, data.datadir)
+    return Assembly.stats_figure(df, [s for s in stats if s in df.columns])
+
+
+FIGURES = {'pca': _pca, 'sample_distances': _sample_distances, 'volcano': _volcano, 'ranking': _ranking,
+           'expression': _expression, 'assembly': _assembly}
+
+
+def plan(datadir, config, genes):
+    """(section, title, figure, args) of every figure of a project, in report order."""
+    data = datasets.get_registry(datadir)
+    pages = config['pages']
+    tasks = []
+    if 'EDA' in pages and data.has('vsd'):
+        tasks += [('EDA', 'PCA', 'pca', ()), ('EDA', 'Sample distances', 'sample_distances', ())]
+    if 'DiffAb' in pages and data.has('results'):
+        # Only the contrast column is read here, the workers load the full table
+        contrasts = data.read_table('results', columns=['contrast'], dtype={'contrast': str})['contrast']
+        for contrast in sorted(contrasts.dropna().unique()):
+            tasks += [('DiffAb', f'{contrast}: volcano plot', 'volcano', (contrast,)),
+                      ('DiffAb', f'{contrast}: LFC ranking', 'ranking', (contrast,))]
+    if 'Expression' in pages and data.has('tpms'):
+        tasks += [('Expression', gene, 'expression', (gene,)) for gene in genes]
+    if 'Assembly' in pages:
+        # Reports are small, read here to leave out sections none of their metrics belong to
+        reports = data.derive('assembly_reports', Assembly.load_reports, datadir)
+        for title, stats in [('Statistics for contigs >= 500 bp', Assembly.STATS),
+                             ('Reference-based stats', Assembly.REFERENCE_STATS)]:
+            if reports is not None and any(s in reports.columns for s in stats):
+                tasks.append(('Assembly', title, 'assembly', (stats,)))
+    return tasks
+
+
+def report_names(tar_files):
+    """Report file stem of each tarball, its archive suffix stripped and numbered by position when shared."""
+    names = []
+    for tar_file in tar_files:
+        name = Path(tar_file).name
+        for suffix in ('.tar.gz', '.tgz', '.tar'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        names.append(name)
+    return [f'{name}_{i + 1}' if names.count(name) > 1 else name for i, name in enumerate(names)]
+
+
+def render_figure(datadir, figure, args, options):
+    """HTML fragment of one figure, built in a worker. Errors are returned as text for the report."""
+    try:
+        fig = FIGURES[figure](datasets.get_registry(datadir), options, *args)
+    except Exception:
+        return f'<p class="error">{html.escape(traceback.format_exc())}</p>'
+    if fig is None:
+        return '<p>Not found</p>'
+    return fig.to_html(full_html=False, include_plotlyjs=False, config={'responsive': True})
+
+
+def write_report(out_file, config, tasks, fragments):
+    title = html.escape(str(config.get('projectName', Path(out_file).stem)))
+    sections = list(dict.fromkeys(section for section, *_ in tasks))
+    parts = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">', f'<title>{title}</title>', STYLE,
+             f'<script type="text/javascript">{get_plotlyjs()}</script>', '</head><body>', f'<h1>{title}</h1>',
+             '<nav>' + ''.join(f'<a href="#{s}">{s}</a>' for s in sections) + '</nav>']
+    for section in sections:
+        parts.append(f'<h2 id="{section}">{section}</h2>')
+        for (s, name, *_), fragment in zip(tasks, fragments):
+            if s == section:
+                parts.append(f'<div class="figure"><h3>{html.escape(name)}</h3>{fragment}</div>')
+    parts.append('</body></html>')
+    Path(out_file).write_text('\n'.join(parts), encoding='utf-8')
+    return out_file
+
+
+def render_reports(bundles, out_dir, genes=(), fdr=0.05, lfc=1.0, n_jobs=None):
+    """
+    Write one <bundle name>.html per results tarball to out_dir (see report_names), returns their paths.
+
+    :param genes: names or synonyms of the genes to plot from Expression
+    :param n_jobs: worker processes, defaults to one per CPU
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    options = {'fdr': fdr, 'lfc': lfc}
+    projects = []
+    for tar_file in bundles:
+        with open(tar_file, 'rb') as fh:
+            datadir, config, _ = bundle.open_bundle(fh)
+        projects.append((Path(tar_file), datadir, config, plan(datadir, config, genes)))
+    with ProcessPoolExecutor(n_jobs or os.cpu_count()) as pool:
+        futures = [[pool.submit(render_figure, datadir, figure, args, options) for _, _, figure, args in tasks]
+                   for _, datadir, _, tasks in projects]
+        written = []
+        names = report_names([tar_file for tar_file, *_ in projects])
+        for (_, _, config, tasks), name, project_futures in zip(projects, names, futures):
+            out_file = write_report(out_dir / f'{name}.html', config, tasks, [f.result() for f in project_futures])
+            print(out_file, flush=True)
+            written.append(out_file)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('bundles', nargs='+', help='Results tarballs, as uploaded to the app')
+    parser.add_argument('--out', default='reports', help='Directory the reports are written to')
+    parser.add_argument('--genes', nargs='*', default=[], help='Genes to plot on the Expression page')
+    parser.add_argument('--gene-file', help='File with one gene per line, added to --genes')
+    parser.add_argument('--fdr', type=float, default=0.05)
+    parser.add_argument('--lfc', type=float, default=1.0, help='Absolute log fold change cutoff')
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+    genes = list(args.genes)
+    if args.gene_file:
+        genes += [line.strip() for line in open(args.gene_file) if line.strip()]
+    render_reports(args.bundles, args.out, genes, args.fdr, args.lfc, args.jobs)